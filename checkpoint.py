@@ -0,0 +1,131 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import os.path
+import threading
+import time
+from typing import Optional
+
+SYNC_INTERVAL = 10  # seconds between fsync calls
+
+
+class JournalMismatch(Exception):
+    pass
+
+
+class Journal:
+    """
+    Append-only journal of completed batches, one JSON line per batch.
+    The first line is a header describing the run, so that a journal of a different run is not resumed.
+    Each batch is flushed when written and synced to disk at most every SYNC_INTERVAL seconds.
+    A trailing line which was cut off by a crash is ignored when reading.
+    """
+
+    def __init__(self, filename: str, header: dict):
+        self.filename = filename
+        self.header = header
+        self._fh = None
+        self._lock = threading.Lock()
+        self._last_sync = 0
+
+    def load(self) -> list:
+        """
+        Read all batches of an interrupted run.
+        :return: list of batches, each a list of items
+        :raises JournalMismatch: if the journal was written by a run with another header
+        """
+        if not os.path.exists(self.filename):
+            return []
+
+        batches = []
+        with open(self.filename, "r") as fh:
+            for number, line in enumerate(fh):
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # incomplete last line
+                    break
+                if number == 0:
+                    if data != self.header:
+                        raise JournalMismatch("Journal {} belongs to another run: {}".format(self.filename, data))
+                    continue
+                batches.append(data)
+
+        return batches
+
+    def open(self, resume: bool, fresh: bool = False):
+        """
+        Open the journal for writing. Without resume, an existing journal of the same run is replaced.
+        When resuming, the journal is rewritten from the readable batches first, dropping a cut-off last line.
+        :param resume: keep the batches of an interrupted run
+        :param fresh: replace an existing journal, even if it belongs to another run
+        :raises JournalMismatch: if an existing journal belongs to another run and fresh is not set
+        """
+        if fresh:
+            batches = []
+        elif resume:
+            batches = self.load()
+        else:
+            # Do not throw away the results of another interrupted run
+            header = self._read_header()
+            if header is not None and header != self.header:
+                raise JournalMismatch("Journal {} belongs to another run: {}".format(self.filename, header))
+            batches = []
+        self._fh = open(self.filename, "w")
+        for data in [self.header] + batches:
+            self._fh.write(json.dumps(data) + "\n")
+        self._sync()
+
+    def _read_header(self) -> Optional[dict]:
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, "r") as fh:
+            try:
+                return json.loads(fh.readline())
+            except ValueError:
+                # empty or cut-off journal, nothing to protect
+                return None
+
+    def write(self, batch: list):
+        # Called from the result handler thread of the worker pool
+        with self._lock:
+            self._fh.write(json.dumps(batch) + "\n")
+            self._fh.flush()
+            if time.time() - self._last_sync > SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._fh:
+            self._sync()
+            self._fh.close()
+            self._fh = None
+
+    def remove(self):
+        """
+        Remove the journal after the run was completed and all results were persisted.
+        """
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
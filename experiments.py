@@ -18,6 +18,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from typing import Dict, Any
 
+import records
+
 
 def check_multihost(ip_cache: dict, asn_cache: dict) -> Dict[str, Dict[str, Any]]:
     """
@@ -31,11 +33,11 @@ def check_multihost(ip_cache: dict, asn_cache: dict) -> Dict[str, Dict[str, Any]
     asns = {}  # keys are ASNs, values list of hostnames
     asn_to_as: Dict[int, str] = {}
     for instanceName, data in asn_cache.items():
-        for network in data["asn"]:
-            asn: int = network["asn"]
+        for network in data.asn:
+            asn: int = network.asn
 
             if asn not in asn_to_as:
-                asn_to_as[asn] = network["name"]
+                asn_to_as[asn] = network.name
 
             if asn not in asns:
                 asns[asn] = set()
@@ -46,13 +48,13 @@ def check_multihost(ip_cache: dict, asn_cache: dict) -> Dict[str, Dict[str, Any]
     ip_groups: Dict[str, Dict[str, set]] = {}  # IP address -> [AS, hostnames]
     for asn, instanceNames in asns.items():
         for hostname in instanceNames:
-            # IPs are strings
+            # IPs are integers in the cache, the groups are keyed by their string form
 
             if hostname not in ip_cache:
                 # Sometimes AS and IP caches are out of sync
                 continue
 
-            ipv4: [str] = ip_cache.get(hostname)["v4"]
+            ipv4: [str] = [records.ip_to_str(4, ip) for ip in ip_cache.get(hostname).v4]
             for ip in ipv4:
                 if ip not in ip_groups:
                     ip_groups[ip] = {
@@ -61,7 +63,7 @@ def check_multihost(ip_cache: dict, asn_cache: dict) -> Dict[str, Dict[str, Any]
                     }
                 ip_groups[ip]["instances"].add(hostname)
 
-            ipv6: [str] = ip_cache.get(hostname)["v6"]
+            ipv6: [str] = [records.ip_to_str(6, ip) for ip in ip_cache.get(hostname).v6]
             for ip in ipv6:
                 if ip not in ip_groups:
                     ip_groups[ip] = {
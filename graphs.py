@@ -112,3 +112,41 @@ def _plot(sorted_by_instances: bool, x, y1, y2, filename: str, sorted_by: str):
 
     fig.tight_layout()
     plt.savefig(filename, format='png', transparent=False)
+
+
+def plot_estimates(x, users, users_err, instances, instances_err, sample_size: int, confidence: float,
+                   filename: str = "graph_estimates.png"):
+    """
+    Plot estimated user and instance shares per hoster with their confidence intervals as error bars
+    :param users_err: 2xN list of distances from the estimates to the lower and upper bounds
+    :param instances_err: 2xN list of distances from the estimates to the lower and upper bounds
+    """
+    fig, ax1 = plt.subplots(1, 1, figsize=(14, 6))
+
+    x_ar = np.arange(len(x))
+    width = 0.4  # the width of the bars
+
+    ax1.set_xlabel('Hosting provider (AS)')
+    ax1.set_ylabel("Estimated share in %", fontsize=FONTSIZE)
+
+    rects1 = ax1.bar(x_ar - width / 2, users, width, yerr=users_err, capsize=2,
+                     color="xkcd:leaf green", zorder=50)
+    rects2 = ax1.bar(x_ar + width / 2, instances, width, yerr=instances_err, capsize=2,
+                     color="xkcd:cornflower blue", alpha=0.5, zorder=50)
+
+    ax1.set_xticks(ticks=x_ar)
+    ax1.set_xticklabels(x, {'fontsize': FONTSIZE, 'rotation': 15, 'horizontalalignment': 'right'})
+    ax1.set_xmargin(0.01)  # margin factor left and right
+
+    ax1.set_title('Mastodon infrastructure in 2020 - estimated shares from a stratified sample of {} instances '
+                  '({}% confidence intervals, source instances.social {}, published @ bitkeks.eu)'.format(
+                    sample_size, round(confidence * 100), "2020-03-04"),
+                  fontsize=10)
+
+    autolabel(ax1, rects1)
+    autolabel(ax1, rects2)
+
+    plt.legend([rects1, rects2], ["estimated share of users", "estimated share of instances"], loc='upper center')
+
+    fig.tight_layout()
+    plt.savefig(filename, format='png', transparent=False)
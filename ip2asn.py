@@ -16,17 +16,174 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import bisect
 import csv
+import glob
 import gzip
 import ipaddress
 import json
 import os.path
 import hashlib
+import re
+
+from typing import Optional
 
 from tqdm import tqdm
 
+SLICE_SIZE = 1000
+
 ipaddressified_ip_networks = {}
 
+# Merged (start, end) integer ranges per IP version which changed compared to the previously cached AS file
+asnfile_changes = {4: [], 6: []}
+# Caches of previous AS files, removed once the changes were applied to the ASN cache
+outdated_cachefiles = []
+
+
+class _TrieNode:
+    __slots__ = ("key", "length", "children", "entry")
+
+    def __init__(self, key: int, length: int, entry: Optional[tuple] = None):
+        self.key = key  # network address as integer, host bits are zero
+        self.length = length  # prefix length
+        self.children = [None, None]
+        self.entry = entry
+
+
+class PrefixTrie:
+    """
+    Compressed binary radix trie (PATRICIA trie) mapping IP prefixes to AS entries.
+    Nodes only exist where prefixes are stored or branch, so a lookup visits a handful of nodes
+    instead of all 32 or 128 bits. Lookups return the entry of the longest matching prefix.
+    IPv4 and IPv6 prefixes are held in separate roots.
+    """
+
+    def __init__(self):
+        self._roots = {4: _TrieNode(0, 0), 6: _TrieNode(0, 0)}
+        self._widths = {4: 32, 6: 128}
+        self._masks = {version: [((1 << length) - 1) << (width - length) for length in range(width + 1)]
+                       for version, width in self._widths.items()}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, network: [ipaddress.IPv4Network, ipaddress.IPv6Network], entry: tuple):
+        """
+        Store an entry for a network. An existing entry for exactly the same prefix is replaced.
+        :param network: ipaddress network object
+        :param entry: tuple of (asn, country, name, start, end), with start and end as integers
+        """
+        width = self._widths[network.version]
+        masks = self._masks[network.version]
+        key = int(network.network_address)
+        length = network.prefixlen
+        node = self._roots[network.version]
+
+        while True:
+            if node.length == length:
+                if node.entry is None:
+                    self._size += 1
+                node.entry = entry
+                return
+
+            bit = (key >> (width - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _TrieNode(key, length, entry)
+                self._size += 1
+                return
+
+            # Length of the common prefix of the new network and the child
+            common = min(length, child.length, width - (key ^ child.key).bit_length())
+            if common == child.length:
+                node = child
+                continue
+
+            # Split the compressed edge to the child with an intermediate node
+            middle = _TrieNode(key & masks[common], common)
+            middle.children[(child.key >> (width - common - 1)) & 1] = child
+            if common == length:
+                middle.entry = entry
+            else:
+                middle.children[(key >> (width - common - 1)) & 1] = _TrieNode(key, length, entry)
+            node.children[bit] = middle
+            self._size += 1
+            return
+
+    def lookup(self, ip: [ipaddress.IPv4Address, ipaddress.IPv6Address]) -> Optional[dict]:
+        width = self._widths[ip.version]
+        masks = self._masks[ip.version]
+        key = int(ip)
+        node = self._roots[ip.version]
+        best = node.entry
+
+        while node.length < width:
+            child = node.children[(key >> (width - node.length - 1)) & 1]
+            if child is None or key & masks[child.length] != child.key:
+                break
+            node = child
+            if node.entry is not None:
+                best = node.entry
+
+        if best is None:
+            return None
+
+        asn, country, name, start, end = best
+        address = ipaddress.IPv4Address if ip.version == 4 else ipaddress.IPv6Address
+        return {
+            "start": address(start),
+            "end": address(end),
+            "asn": asn,
+            "country": country,
+            "name": name
+        }
+
+    def to_json(self) -> dict:
+        """
+        Serialize the nodes in preorder as columns, so that the trie can be rebuilt without inserting each prefix
+        """
+        data = {}
+        for version, root in self._roots.items():
+            keys, lengths, children, entries = [], [], [], []
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                keys.append(node.key)
+                lengths.append(node.length)
+                # bit 0: node has a 0-child, bit 1: node has a 1-child
+                children.append((node.children[0] is not None) | (node.children[1] is not None) << 1)
+                entries.append(node.entry)
+                stack.extend(child for child in reversed(node.children) if child is not None)
+            data[str(version)] = {"keys": keys, "lengths": lengths, "children": children, "entries": entries}
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "PrefixTrie":
+        trie = cls()
+        for version, columns in data.items():
+            nodes = iter(zip(columns["keys"], columns["lengths"], columns["children"], columns["entries"]))
+            key, length, children, entry = next(nodes)
+            root = _TrieNode(key, length, tuple(entry) if entry else None)
+            trie._roots[int(version)] = root
+            trie._size += entry is not None
+
+            # Each stack item is a node and the bits of its children which are not yet rebuilt
+            stack = [(root, children)]
+            while stack:
+                node, pending = stack[-1]
+                if not pending:
+                    stack.pop()
+                    continue
+                bit = 0 if pending & 1 else 1
+                stack[-1] = (node, pending & ~(1 << bit))
+                key, length, children, entry = next(nodes)
+                child = _TrieNode(key, length, tuple(entry) if entry else None)
+                node.children[bit] = child
+                trie._size += entry is not None
+                stack.append((child, children))
+        return trie
+
 
 def ipaddressify_ip_networks(ip_networks: list) -> list:
     # print("Converting ip_networks to list with ipaddress.ip_address objects")
@@ -38,13 +195,75 @@ def ipaddressify_ip_networks(ip_networks: list) -> list:
     return new_ip_networks
 
 
-def asnfile_init(filename: str) -> dict:
+def _read_asnfile(filename: str) -> list:
+    if filename.endswith(".gz"):
+        fh = gzip.open(filename, "rt")
+    else:
+        fh = open(filename, "r")
+
+    tsv = csv.reader(fh, delimiter="\t")
+
+    entries = []
+    for row in tqdm(tsv, desc="Parsing entries in AS file {}".format(filename)):
+        entries.append({
+            "start": row[0],
+            "end": row[1],
+            "asn": int(row[2]),
+            "country": row[3],
+            "name": row[4]
+        })
+
+    fh.close()
+
+    return entries
+
+
+def _slice_entries(entries: list) -> dict:
+    # Using slices to chop up >400.000 entries which would later need to be iterated in whole.
+    # Each slice is keyed by the start IP of its first entry.
     ip_networks = {}
+    for offset in range(0, len(entries), SLICE_SIZE):
+        ip_networks[entries[offset]["start"]] = entries[offset:offset + SLICE_SIZE]
+    return ip_networks
+
+
+def _entry_key(entry: dict) -> tuple:
+    return entry["start"], entry["end"], entry["asn"], entry["country"], entry["name"]
+
+
+def _cachefile_version(cachefile: str) -> Optional[int]:
+    # The first slice key at the beginning of the file tells the IP version without loading the whole index
+    with gzip.open(cachefile, "rt") as fh:
+        match = re.match(r'\{"ip_networks": \{"([^"]+)"', fh.read(256))
+    return ipaddress.ip_address(match.group(1)).version if match else None
+
+
+def _record_changes(version: int, entries: list):
+    ranges = sorted(asnfile_changes[version] + [(int(ipaddress.ip_address(entry["start"])),
+                                                 int(ipaddress.ip_address(entry["end"]))) for entry in entries])
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    asnfile_changes[version] = merged
+
+
+def overlaps_changes(version: int, start: int, end: int) -> bool:
+    """
+    Check if the range from start to end overlaps with a range that changed in the last loaded AS file.
+    Single IPs are checked by passing them as start and end.
+    :param version: IP version, 4 or 6
+    :param start: first IP of the range as integer
+    :param end: last IP of the range as integer
+    """
+    changes = asnfile_changes[version]
+    position = bisect.bisect_right(changes, (end, float("inf"))) - 1
+    return position >= 0 and changes[position][1] >= start
 
-    if not os.path.exists(filename):
-        raise FileNotFoundError
 
-    # Check hash of cache file
+def file_hash(filename: str) -> str:
     filehash = hashlib.sha1()
     with open(filename, 'rb') as fh:
         while True:
@@ -52,62 +271,189 @@ def asnfile_init(filename: str) -> dict:
             if not data:
                 break
             filehash.update(data)
+    return filehash.hexdigest()
+
+
+def asnfile_init(filename: str) -> dict:
+    """
+    Load an iptoasn.com range file into a sliced index, cached by the hash of the file.
+    If there is no cache for the file yet, the index is built from the file. The ranges which differ from the
+    cached previous file of the same IP version are recorded in asnfile_changes, and its cache in
+    outdated_cachefiles.
+    :param filename: path to the range file, optionally gzipped
+    :return: dict of slice start IP to list of entries
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError
 
     # construct file name from hash
-    cachefile = ".asnfile_cached_{}.gz".format(filehash.hexdigest())
+    cachefile = ".asnfile_cached_{}.gz".format(file_hash(filename))
 
     if os.path.exists(cachefile):
         with gzip.open(cachefile, "rt") as fh:
             # print("Using cached parsing result")
-            return json.load(fh)["ip_networks"]
-
-    if filename.endswith(".gz"):
-        fh = gzip.open(filename, "rt")
+            ip_networks = json.load(fh)["ip_networks"]
+        entries = [entry for slice_entries in ip_networks.values() for entry in slice_entries]
     else:
-        fh = open(filename, "r")
+        entries = _read_asnfile(filename)
+        # Slicing the parsed entries is cheaper than patching the previous index, the diff is only needed for the
+        # invalidation of the ASN cache
+        ip_networks = _slice_entries(entries)
+        with gzip.open(cachefile, "wt") as fh:
+            print("Persisting cache file for AS parsing {}".format(filename))
+            json.dump({"ip_networks": ip_networks}, fh)
+
+    if not entries:
+        return {}
+    version = ipaddress.ip_address(entries[0]["start"]).version
+
+    # Previous caches of the same IP version, newest first. They are only removed by remove_outdated_cachefiles
+    # after the invalidated ASN cache was saved, so an interrupted run diffs against them again.
+    previous_cachefiles = sorted([cf for cf in glob.glob(".asnfile_cached_*.gz")
+                                  if cf != cachefile and _cachefile_version(cf) == version],
+                                 key=os.path.getmtime, reverse=True)
+
+    if previous_cachefiles:
+        with gzip.open(previous_cachefiles[0], "rt") as fh:
+            previous_networks = json.load(fh)["ip_networks"]
+
+        previous_keys = {_entry_key(entry): entry for slice_entries in previous_networks.values()
+                         for entry in slice_entries}
+        keys = set(_entry_key(entry) for entry in entries)
+        removed = [entry for key, entry in previous_keys.items() if key not in keys]
+        added = [entry for entry in entries if _entry_key(entry) not in previous_keys]
+        print("AS file {} differs from the previous one by {} removed and {} added ranges".format(
+            filename, len(removed), len(added)))
+
+        _record_changes(version, removed + added)
+        outdated_cachefiles.extend(previous_cachefiles)
 
-    tsv = csv.reader(fh, delimiter="\t")
+    return ip_networks
 
-    # Using slices to chop up >400.000 entries which would later need to be iterated in whole
-    current_slice = None
-    current_slice_size = 0
 
-    for row in tqdm(tsv, desc="Parsing entries in AS file {}".format(filename)):
-        if current_slice is None:
-            # Initialization
-            current_slice = row[0]
+def remove_outdated_cachefiles():
+    """
+    Remove the caches of previous AS files, which were replaced by asnfile_init.
+    Call this after the ASN cache entries in asnfile_changes were invalidated and the ASN cache was saved.
+    """
+    for cachefile in outdated_cachefiles:
+        if os.path.exists(cachefile):
+            os.remove(cachefile)
+    outdated_cachefiles.clear()
 
-        if current_slice_size == 1000:
-            current_slice = row[0]
-            current_slice_size = 0
 
-        if current_slice not in ip_networks:
-            ip_networks[current_slice] = []
+def asnames_init(filename: str) -> dict:
+    """
+    Load AS names in the JSON format of pyasn_util_asnames.py, e.g. {"13335": "CLOUDFLARENET - Cloudflare, Inc., US"}
+    :param filename: path to the JSON file, optionally gzipped
+    :return: dict of ASN (int) to AS name
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError
 
-        entry = {
-            "start": row[0],
-            "end": row[1],
-            "asn": int(row[2]),
-            "country": row[3],
-            "name": row[4]
-        }
+    with (gzip.open(filename, "rt") if filename.endswith(".gz") else open(filename, "r")) as fh:
+        return {int(asn): name for asn, name in json.load(fh).items()}
+
+
+def prefixfile_init(filename: str, asnames: Optional[dict] = None, trie: Optional[PrefixTrie] = None) -> PrefixTrie:
+    """
+    Parse a prefix table into a radix trie. Two formats are accepted, detected per line:
+     * pyasn-style BGP dumps with "prefix<TAB>asn", e.g. "1.1.1.0/24\t13335". Lines starting with ";" are comments.
+     * iptoasn.com range files with "start<TAB>end<TAB>asn<TAB>country<TAB>name", split into covering prefixes.
+    :param filename: path to the prefix table, optionally gzipped
+    :param asnames: dict of ASN to AS name, used for prefix tables which carry no names
+    :param trie: existing trie to add the prefixes to, e.g. to combine IPv4 and IPv6 tables
+    :return: the trie
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError
 
-        ip_networks[current_slice].append(entry)
-        current_slice_size += 1
+    asnames = asnames or {}
+    trie = trie if trie is not None else PrefixTrie()
+
+    if filename.endswith(".gz"):
+        fh = gzip.open(filename, "rt")
+    else:
+        fh = open(filename, "r")
+
+    for line in tqdm(fh, desc="Parsing prefixes in file {}".format(filename)):
+        if not line.strip() or line.startswith((";", "#")):
+            continue
+
+        row = line.rstrip("\n").split("\t")
+        if len(row) == 2:
+            network = ipaddress.ip_network(row[0], strict=False)
+            try:
+                asn = int(row[1])
+            except ValueError:
+                # AS sets like "{64512,64513}" have no single origin
+                continue
+            entry = (asn, "", asnames.get(asn, "AS{}".format(asn)),
+                     int(network.network_address), int(network.broadcast_address))
+            trie.insert(network, entry)
+        elif len(row) == 5:
+            start, end = ipaddress.ip_address(row[0]), ipaddress.ip_address(row[1])
+            entry = (int(row[2]), row[3], row[4], int(start), int(end))
+            for network in ipaddress.summarize_address_range(start, end):
+                trie.insert(network, entry)
 
     fh.close()
 
+    return trie
+
+
+def prefixfiles_init(filenames: list, asnames: Optional[dict] = None) -> PrefixTrie:
+    """
+    Load prefix tables into one radix trie, cached by the hash of the files and the AS names.
+    Outdated caches are removed.
+    :param filenames: paths to the prefix tables, see prefixfile_init
+    :param asnames: dict of ASN to AS name, used for prefix tables which carry no names
+    :return: the trie
+    """
+    # The AS names are part of the entries, so they are part of the hash
+    filehash = hashlib.sha1(json.dumps(asnames or {}, sort_keys=True).encode("utf-8"))
+    for filename in filenames:
+        if not os.path.exists(filename):
+            raise FileNotFoundError
+        with open(filename, 'rb') as fh:
+            while True:
+                data = fh.read(65536)  # read in 64kb chunks
+                if not data:
+                    break
+                filehash.update(data)
+
+    cachefile = ".prefixfile_cached_{}.gz".format(filehash.hexdigest())
+
+    if os.path.exists(cachefile):
+        with gzip.open(cachefile, "rt") as fh:
+            return PrefixTrie.from_json(json.load(fh)["trie"])
+
+    trie = None
+    for filename in filenames:
+        trie = prefixfile_init(filename, asnames, trie)
+
     with gzip.open(cachefile, "wt") as fh:
-        print("Persisting cache file for AS parsing {}".format(filename))
-        json.dump({"ip_networks": ip_networks}, fh)
+        print("Persisting cache file for prefix parsing {}".format(", ".join(filenames)))
+        json.dump({"trie": trie.to_json()}, fh)
 
-    return ip_networks
+    # The new cache replaces the caches of previous versions of the tables
+    for previous_cachefile in glob.glob(".prefixfile_cached_*.gz"):
+        if previous_cachefile != cachefile:
+            os.remove(previous_cachefile)
 
+    return trie
 
-def get_asn_of_ip(ip: [str, ipaddress.IPv4Address, ipaddress.IPv6Address], ip_networks: dict) -> list:
+
+def get_asn_of_ip(ip: [str, ipaddress.IPv4Address, ipaddress.IPv6Address],
+                  ip_networks: [dict, PrefixTrie]) -> list:
     if not type(ip) in [ipaddress.IPv4Address, ipaddress.IPv6Address]:
         ip = ipaddress.ip_address(ip)
 
+    if isinstance(ip_networks, PrefixTrie):
+        # Longest prefix match, there is at most one candidate
+        network = ip_networks.lookup(ip)
+        return [network] if network is not None and network["asn"] != 0 else []
+
     candidates = []
     # Iterate over slices to find the right network slice
     match = None
@@ -136,7 +482,7 @@ def get_asn_of_ip(ip: [str, ipaddress.IPv4Address, ipaddress.IPv6Address], ip_ne
     # The IP that is searched for is in the last matched slice
     for network in converted_network:
         # Using ipaddress objects as network start and end
-        if network["start"] < ip < network["end"] and network["asn"] != 0:
+        if network["start"] <= ip <= network["end"] and network["asn"] != 0:
             candidates.append(network)
 
     return candidates
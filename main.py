@@ -18,22 +18,32 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
 import csv
+import ipaddress
 import json
+import threading
 import time
 from multiprocessing.pool import ThreadPool
 import socket
-from collections import namedtuple
+from collections import namedtuple, Counter
 from tqdm import tqdm
 import os.path
 
+import checkpoint
 import ip2asn
-from graphs import plot_by_instances, plot_by_users, plot_by_active_users
+import probe
+import profiling
+import records
+import sampling
+import shards
 import experiments
+from graphs import plot_by_instances, plot_by_users, plot_by_active_users, plot_estimates
 
 NUM_WORKERS = 4
 CACHEFILE_NOIP = ".cache_no_ip"
 CACHEFILE_IP = ".cache_ip"
 CACHEFILE_ASN = ".cache_asn"
+CACHEFILE_PROBE = ".cache_probe"
+CHECKPOINT_FILE = ".checkpoint"
 
 HOSTER_MAP = {
     "cloudflarenet": "cloudflare",
@@ -66,7 +76,7 @@ HOSTER_MAP = {
 
 
 WorkerResult = namedtuple('WorkerResult', ['hostname', 'v4', 'v6', 'asn'])
-CleanupStats = namedtuple('CleanupStats', ['ip', 'no_ip', 'asn'])
+CleanupStats = namedtuple('CleanupStats', ['ip', 'no_ip', 'asn', 'probe'])
 
 
 def read_instances(filename: str) -> dict:
@@ -74,6 +84,22 @@ def read_instances(filename: str) -> dict:
         return json.load(fh)
 
 
+def worker_result_to_json(wr: WorkerResult) -> dict:
+    return {
+        "hostname": wr.hostname,
+        "v4": [records.ip_to_str(4, ip) for ip in wr.v4],
+        "v6": [records.ip_to_str(6, ip) for ip in wr.v6],
+        "asn": [records.as_network_to_json(network) for network in wr.asn]
+    }
+
+
+def worker_result_from_json(data: dict) -> WorkerResult:
+    return WorkerResult(data["hostname"],
+                        tuple(int(ipaddress.IPv4Address(ip)) for ip in data["v4"]),
+                        tuple(int(ipaddress.IPv6Address(ip)) for ip in data["v6"]),
+                        tuple(records.as_network(network) for network in data["asn"]))
+
+
 def map_whois_to_hoster(item: str) -> [str, None]:
     for hoster in HOSTER_MAP:
         if hoster in item.lower():  # match substrings
@@ -99,8 +125,8 @@ def cleanup_cachefiles() -> CleanupStats:
     Cleans up the cache files based on the entries timeouts
     :return:
     """
-    global ip_cache, no_ip_cache, asn_cache
-    stats = [0, 0, 0]
+    global ip_cache, no_ip_cache, asn_cache, probe_cache
+    stats = [0, 0, 0, 0]
 
     # temporary list of cleanup candidates
     deletion_candidates = []
@@ -108,10 +134,10 @@ def cleanup_cachefiles() -> CleanupStats:
     # load IP cache
     if os.path.exists(CACHEFILE_IP):
         with open(CACHEFILE_IP, "r") as fh:
-            ip_cache = json.load(fh)
+            ip_cache = {hostname: records.ip_cache_from_json(data) for hostname, data in json.load(fh).items()}
     # clean up IP cache
     for hostname in ip_cache:
-        if ip_cache[hostname]["timestamp"] < (time.time() - 60 * 60):  # one hour
+        if ip_cache[hostname].timestamp < (time.time() - 60 * 60):  # one hour
             # exceeded timeout
             deletion_candidates.append(hostname)
     for can in deletion_candidates:
@@ -137,31 +163,109 @@ def cleanup_cachefiles() -> CleanupStats:
     # load and clean cache file with ASN mappings
     if os.path.exists(CACHEFILE_ASN):
         with open(CACHEFILE_ASN, "r") as fh:
-            asn_cache = json.load(fh)
+            asn_cache = {hostname: records.asn_cache_from_json(data) for hostname, data in json.load(fh).items()}
     for hostname in asn_cache:
-        if asn_cache[hostname]["timestamp"] < (time.time() - 60 * 60 * 6):  # six hours
+        if asn_cache[hostname].timestamp < (time.time() - 60 * 60 * 6):  # six hours
             deletion_candidates.append(hostname)
     for can in deletion_candidates:
         del asn_cache[can]
 
     stats[2] = len(deletion_candidates)
+    deletion_candidates.clear()
+
+    # load and clean cache file with HTTP probe results
+    if os.path.exists(CACHEFILE_PROBE):
+        with open(CACHEFILE_PROBE, "r") as fh:
+            probe_cache = json.load(fh)
+    for hostname in probe_cache:
+        # Failed probes are often transient (timeouts, resets) and are retried sooner
+        if probe_cache[hostname]["error"]:
+            timeout = 60 * 15  # fifteen minutes
+        else:
+            timeout = 60 * 60 * 24  # one day
+        if probe_cache[hostname]["timestamp"] < (time.time() - timeout):
+            deletion_candidates.append(hostname)
+    for can in deletion_candidates:
+        del probe_cache[can]
+
+    stats[3] = len(deletion_candidates)
 
     return CleanupStats(*stats)
 
 
+def invalidate_asn_cache() -> int:
+    """
+    Removes ASN cache entries which might be outdated after the AS files were patched with a newer version.
+    Only hostnames whose IPs or cached networks overlap with changed ranges are affected.
+    :return: number of removed entries
+    """
+    deletion_candidates = []
+    for hostname, entry in asn_cache.items():
+        ranges = [(network.version, network.start, network.end) for network in entry.asn]
+        if hostname in ip_cache:
+            ranges += [(4, ip, ip) for ip in ip_cache[hostname].v4] + [(6, ip, ip) for ip in ip_cache[hostname].v6]
+        if any(ip2asn.overlaps_changes(version, start, end) for version, start, end in ranges):
+            deletion_candidates.append(hostname)
+    for can in deletion_candidates:
+        del asn_cache[can]
+
+    return len(deletion_candidates)
+
+
+def print_memory_report(raw_instances_size: int, instances: list, worker_results: list):
+    """
+    Compare the memory of the compact records with the plain dicts and strings they were loaded from.
+    The plain representations are created from the records, as they are stored in the JSON files.
+    """
+    rows = [
+        ("instances", raw_instances_size, profiling.deep_sizeof(instances)),
+        ("ip_cache", profiling.deep_sizeof({hostname: records.ip_cache_to_json(entry)
+                                            for hostname, entry in ip_cache.items()}),
+         profiling.deep_sizeof(ip_cache)),
+        ("asn_cache", profiling.deep_sizeof({hostname: records.asn_cache_to_json(entry)
+                                             for hostname, entry in asn_cache.items()}),
+         profiling.deep_sizeof(asn_cache)),
+        ("worker_results", profiling.deep_sizeof([worker_result_to_json(wr) for wr in worker_results]),
+         profiling.deep_sizeof(worker_results))
+    ]
+
+    print(f"\nMemory usage ({records.string_table_size()} interned AS names and countries)")
+    print("{:<16} {:>12} {:>12} {:>8}".format("structure", "plain KiB", "compact KiB", "saved"))
+    for name, plain, compact in rows + [("total", sum(r[1] for r in rows), sum(r[2] for r in rows))]:
+        saved = round((1 - compact / plain) * 100, 1) if plain else 0
+        print("{:<16} {:>12.1f} {:>12.1f} {:>7}%".format(name, plain / 1024, compact / 1024, saved))
+
+
+def count_resolution(**counts):
+    with resolution_stats_lock:
+        resolution_stats.update(counts)
+
+
+def ip_to_as_networks(version: int, ip: int) -> tuple:
+    """
+    Map an IP to its AS networks, looking up each distinct IP only once per run.
+    Two workers may look up the same new IP at the same time, the results are equal then.
+    """
+    key = (version, ip)
+    if key not in ip_asn_cache:
+        ip_networks = ip_networks_ipv4 if version == 4 else ip_networks_ipv6
+        ip_asn_cache[key] = tuple(records.as_network(network) for network in
+                                  ip2asn.get_asn_of_ip(records.ip_to_address(version, ip), ip_networks))
+        count_resolution(asn_lookups=1)
+    return ip_asn_cache[key]
+
+
 def worker(hostnames: list) -> [WorkerResult]:
     results = []
     for hostname in hostnames:
         v4, v6 = hostname_to_ips(hostname)
 
         if hostname in asn_cache:
-            asn: list = asn_cache[hostname]["asn"]
+            asn: tuple = asn_cache[hostname].asn
         else:
-            asn = []
-            for ip in v4:
-                asn += ip2asn.get_asn_of_ip(ip, ip_networks_ipv4)
-            for ip in v6:
-                asn += ip2asn.get_asn_of_ip(ip, ip_networks_ipv6)
+            asn = tuple(network for version, ips in [(4, v4), (6, v6)] for ip in ips
+                        for network in ip_to_as_networks(version, ip))
+            count_resolution(mapped_ips=len(v4) + len(v6))
 
         results.append(WorkerResult(hostname, v4, v6, asn))
     counter.update(len(hostnames))
@@ -169,25 +273,286 @@ def worker(hostnames: list) -> [WorkerResult]:
 
 
 def hostname_to_ips(hostname: str) -> tuple:
+    """
+    Resolve a hostname to its IPv4 and IPv6 addresses.
+    The addresses of CNAME targets are recorded, so a hostname which is itself the target of an already resolved
+    alias is not queried again.
+    :return: tuple of (IPv4 addresses, IPv6 addresses), each a tuple of integers
+    """
     if hostname in ip_cache:
         # load IP addresses from cache
-        return ip_cache[hostname]["v4"], ip_cache[hostname]["v6"]
+        return ip_cache[hostname].v4, ip_cache[hostname].v6
+
+    if hostname in canonical_targets:
+        # the hostname is the target of an already resolved alias
+        count_resolution(known_targets=1)
+        return canonical_targets[hostname]
 
     ipv4 = []
     ipv6 = []
+    canonical_name = None
     try:
-        for s in socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP):
+        for s in socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP, flags=socket.AI_CANONNAME):
+            # only the first entry holds the canonical name
+            canonical_name = canonical_name or s[3].rstrip(".").lower()
             if s[0] == socket.AF_INET:
-                ipv4.append(s[4][0])
+                ipv4.append(int(ipaddress.IPv4Address(s[4][0])))
             if s[0] == socket.AF_INET6:
-                ipv6.append(s[4][0])
+                # strip the scope of link-local addresses
+                ipv6.append(int(ipaddress.IPv6Address(s[4][0].split("%")[0])))
     except socket.gaierror:
         # [Errno -2] Name or service not known
         pass
+    count_resolution(dns_queries=1)
+
+    ipv4, ipv6 = tuple(ipv4), tuple(ipv6)
+    if (ipv4 or ipv6) and canonical_name and canonical_name != hostname:
+        canonical_targets[canonical_name] = ipv4, ipv6
 
     return ipv4, ipv6
 
 
+def report(merged: shards.MergedResult, output_filename: str):
+    """
+    Print the summaries, plot the graphs and write the CSV file and the markdown table
+    :param merged: results of a single run or merged from the partials of a sharded run
+    :param output_filename: name of the CSV file
+    """
+    counters, analysed_instances = merged.counters, merged.analysed_instances
+    skipped_no_ip, skipped_no_asn = merged.skipped_no_ip, merged.skipped_no_asn
+    skipped_multiple_asn, skipped_unknown_mapping = merged.skipped_multiple_asn, merged.skipped_unknown_mapping
+    probe_results = merged.probe_results
+
+    if skipped_no_ip or skipped_no_asn or skipped_multiple_asn:
+        print(f"Skipped instances: {len(skipped_no_ip)} because of no IP (including cached), "
+              f"{len(skipped_no_asn)} because no ASN were found and "
+              f"{len(skipped_multiple_asn)} because multiple ASNs were found")
+
+    if skipped_unknown_mapping:
+        for hostname, asn_name in skipped_unknown_mapping:
+            print(f"Instance {hostname} skipped because ASN '{asn_name}' could not be mapped")
+
+    for new_hoster, asns in merged.hoster_new_created.items():
+        if len(asns) > 1:
+            print(f"New hoster {new_hoster} created by multiple ASNs: {set(asns)} (total {len(asns)})")
+
+    if probe_results:
+        cdn_fronted = {}
+        for hoster, hostnames in counters.items():
+            for hostname in hostnames:
+                cdn = probe_results[hostname]["cdn"]
+                if cdn:
+                    cdn_fronted.setdefault(cdn, {}).setdefault(hoster, 0)
+                    cdn_fronted[cdn][hoster] += 1
+        failed = sum(1 for result in probe_results.values() if result["error"])
+        print(f"Probed {len(probe_results)} instances via HTTP, {failed} failed")
+        for cdn, hosters in sorted(cdn_fronted.items(), key=lambda x: sum(x[1].values()), reverse=True):
+            print(f"CDN {cdn} fronts {sum(hosters.values())} instances, mapped to ASNs of: {hosters}")
+
+    with profiling.stage("aggregation"):
+        x, y1, y2 = [], [], []
+
+        # Providers with 6-20 instances
+        medium_hosters_instances, medium_hosters_users = 0, 0
+        # Providers with 2-5 instances
+        small_hosters_instances, small_hosters_users = 0, 0
+        # At some point hosters will appear which only host one single instance. Merge them into one provider
+        single_hosters_instances, single_hoster_users = 0, 0
+
+        for hoster, hosted_instances in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
+            hosted_users = 0
+            for instance in hosted_instances:
+                hosted_users += analysed_instances[instance].users
+
+            percent_instances = round(len(hosted_instances) / len(analysed_instances) * 100, 2)
+
+            hi = len(hosted_instances)
+
+            if hi == 1:
+                # Add values to cumulated "others" provider
+                single_hosters_instances += 1
+                single_hoster_users += hosted_users
+                continue
+
+            if hi <= 9:
+                small_hosters_instances += hi
+                small_hosters_users += hosted_users
+                continue
+
+            if hi <= 18:
+                medium_hosters_instances += hi
+                medium_hosters_users += hosted_users
+                continue
+
+            # Hosters with >20 instances
+            x.append(f"{hoster} ({percent_instances}%)")
+            y1.append(len(hosted_instances))
+            y2.append(hosted_users)
+
+        # Append medium hosters
+        x.append("(10-18)")
+        y1.append(medium_hosters_instances)
+        y2.append(medium_hosters_users)
+
+        # Append small hosters as single hoster
+        x.append("(2-9)")
+        y1.append(small_hosters_instances)
+        y2.append(small_hosters_users)
+
+        # At the end, add the "others" provider with the sum of hosted users
+        x.append("(1)")
+        y1.append(single_hosters_instances)
+        y2.append(single_hoster_users)
+
+        # print(x, y1, y2)
+        instances_plot = (x, y1, y2)
+
+        # Iterate again, this time sorting by users
+        # We cannot re-use the data above, since the aggregation of multiple providers into groups (single, small,
+        # medium) might hide big instances, which we would like to examine in this next step.
+
+        users_plots = {}
+        for user_category in ["users", "active_users"]:
+            hosters = {}
+
+            # use 'or 0' because dead instances don't have a value for active_users
+            total_users_fediverse = sum([getattr(insta, user_category) or 0
+                                         for insta in analysed_instances.values()])
+
+            for hoster, hosted_instances in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
+                hosted_users = sum([getattr(analysed_instances[instance], user_category)  # amount
+                                    or 0  # if not None
+                                    for instance in hosted_instances])  # for each instance at this provider
+
+                percent_users = round(hosted_users / total_users_fediverse * 100, 2)
+
+                hosters[f"{hoster} ({percent_users}%)"] = {
+                    "users": hosted_users,
+                    "instances": len(hosted_instances)
+                }
+
+            x, y1, y2 = [], [], []  # reset
+
+            others = 0
+            others_users = 0
+            others_instances = 0
+
+            total_users = 0
+            total_instances = 0
+
+            for hoster, data in sorted(hosters.items(), key=lambda x: x[1]["users"], reverse=True):
+                hosted_users = data["users"]
+                hosted_instances = data["instances"]
+
+                total_users += hosted_users
+                total_instances += hosted_instances
+
+                if len(x) >= 20:
+                    others += 1
+                    others_users += hosted_users
+                    others_instances += hosted_instances
+                    continue
+
+                x.append(hoster)
+                y1.append(hosted_users)
+                y2.append(hosted_instances)
+
+            x.append("Others ({})".format(others))
+            y1.append(others_users)
+            y2.append(others_instances)
+            users_plots[user_category] = (x, y1, y2)
+
+    with profiling.stage("plotting"):
+        plot_by_instances(*instances_plot)
+        plot_by_users(*users_plots["users"])
+        plot_by_active_users(*users_plots["active_users"])
+
+    with profiling.stage("csv"):
+        # Markdown export hack
+        print("\n\nMarkdown export\n\n| Hoster | Users | U% | Instances | I% |")
+        print("|" + "---|" * 5)
+        lines = 0
+        for hoster, data in sorted(hosters.items(), key=lambda x: x[1]["users"], reverse=True):
+            if lines > 20:
+                break
+            hosted_users = data["users"]
+            hosted_instances = data["instances"]
+
+            print("| {hoster} | {users} | {users_p}% | {instances} | {instances_p}% |".format(
+                hoster=hoster,
+                users=hosted_users, users_p=round(hosted_users/total_users*100, 2),
+                instances=hosted_instances, instances_p=round(hosted_instances/total_instances*100, 2)
+            ))
+            lines += 1
+
+        print(f"\n\nWriting CSV file to {output_filename}")
+        with open(output_filename, "w") as fh:
+            csvwriter = csv.writer(fh, delimiter=',')
+            csvwriter.writerow(["instance",
+                                "users", "active_users",
+                                "statuses", "connections",
+                                "ipv6", "hoster",
+                                "hosted_instances", "percent_instances",
+                                "hosted_users", "percent_users"]
+                               + (["cdn", "server", "version"] if probe_results else []))
+
+            for hoster, hostnames in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
+                hosted_users = 0
+                for hostname in hostnames:
+                    hosted_users += analysed_instances[hostname].users
+
+                percent_users = round(hosted_users / total_users * 100, 3)
+                percent_instances = round(len(hostnames) / len(analysed_instances) * 100, 3)
+                # print(hoster, len(hostnames), round(len(hostnames) / len(analysed_instances) * 100, 3),
+                #       hosted_users, percent_users)
+                for hostname in hostnames:
+                    instance = analysed_instances[hostname]
+                    csvwriter.writerow([
+                        hostname,
+                        instance.users, instance.active_users,
+                        instance.statuses, instance.connections,
+                        instance.ipv6, hoster,
+                        len(hostnames), percent_instances,
+                        hosted_users, percent_users]
+                        + ([probe_results[hostname][field] for field in ["cdn", "server", "version"]]
+                           if probe_results else []))
+
+    if merged.sampling:
+        sampling_info = merged.sampling
+        with profiling.stage("bootstrap"):
+            estimates = sampling.estimate_shares(counters, analysed_instances, sampling_info["population"],
+                                                 sampling_info["sampled"], sampling_info["bootstrap"],
+                                                 sampling_info["seed"])
+
+        estimates_filename = "{}_estimates.csv".format(os.path.splitext(output_filename)[0])
+        print(f"\n\nEstimated shares from a sample of {sum(sampling_info['sampled'].values())} of "
+              f"{sum(sampling_info['population'].values())} instances, writing CSV file to {estimates_filename}")
+        with open(estimates_filename, "w") as fh:
+            csvwriter = csv.writer(fh, delimiter=',')
+            csvwriter.writerow(sampling.Estimate._fields)
+            for estimate in estimates:
+                csvwriter.writerow(estimate)
+
+        for estimate in estimates[:10]:
+            print(f"{estimate.hoster}: users {estimate.users}% [{estimate.users_low}-{estimate.users_high}], "
+                  f"instances {estimate.instances}% [{estimate.instances_low}-{estimate.instances_high}]")
+
+        top = estimates[:20]
+        plot_estimates([e.hoster for e in top],
+                       [e.users for e in top], [[e.users - e.users_low for e in top],
+                                                [e.users_high - e.users for e in top]],
+                       [e.instances for e in top], [[e.instances - e.instances_low for e in top],
+                                                    [e.instances_high - e.instances for e in top]],
+                       sum(sampling_info["sampled"].values()), sampling.CONFIDENCE)
+
+    # experiment 1: check IPs which host more than 10 instances
+    for ip, data in sorted(merged.ip_groups.items(), key=lambda x: len(x[1]["instances"]), reverse=True)[:5]:
+        hoster = data["as"]
+        hostnames = data["instances"]
+        if len(hostnames) > 10:
+            print(f"\nIP {ip} ({hoster}) hosts {len(hostnames)} instances: {hostnames}")
+
+
 if __name__ == "__main__":
     # global variables
     count_total = 0
@@ -200,6 +565,12 @@ if __name__ == "__main__":
     skipped_no_ip = []
     no_ip_cache = {}
     asn_cache = {}
+    canonical_targets = {}  # CNAME target -> (IPv4 addresses, IPv6 addresses)
+    ip_asn_cache = {}  # (IP version, IP) -> AS networks
+    resolution_stats = Counter()
+    resolution_stats_lock = threading.Lock()
+    probe_cache = {}
+    probe_results = {}
     skipped_no_asn = []
     skipped_multiple_asn = []
     skipped_unknown_mapping = []
@@ -210,324 +581,329 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--asn-ipv4', type=str, dest="asn_ipv4")
     parser.add_argument('--asn-ipv6', type=str, dest="asn_ipv6")
+    parser.add_argument('--asn-engine', type=str, dest="asn_engine", choices=["range", "radix"], default="range",
+                        help="Lookup engine: 'range' for iptoasn.com range files, 'radix' for a longest prefix match "
+                             "trie accepting prefix tables (e.g. pyasn dumps) and iptoasn.com range files")
+    parser.add_argument('--asn-names', type=str, dest="asn_names",
+                        help="JSON file mapping ASNs to AS names, for prefix tables without names (radix engine)")
     parser.add_argument('--instances-list', type=str, dest="instances_list")
     parser.add_argument("--limit", type=int, dest="instances_top_limit", default=30,
                         help="Limit of instances to look at, top X instances by users")
     parser.add_argument("--output", type=str, dest="output_filename", default="analysis.csv",
                         help="Name of CSV output file")
+    parser.add_argument("--sample", type=float, dest="sample_fraction",
+                        help="Only analyse this fraction (0-1] of the instances, stratified by user count, "
+                             "and estimate the shares of the hosters with confidence intervals")
+    parser.add_argument("--sample-seed", type=int, dest="sample_seed", default=0,
+                        help="Seed for drawing the sample, must be the same for all shards")
+    parser.add_argument("--bootstrap", type=int, dest="bootstrap_replicates", default=sampling.BOOTSTRAP_REPLICATES,
+                        help="Number of bootstrap replicates for the confidence intervals of a sample")
     parser.add_argument("--workers", type=int, dest="num_threads", default=NUM_WORKERS,
                         help="Amount of workers to use")
+    journal_group = parser.add_mutually_exclusive_group()
+    journal_group.add_argument("--resume", action="store_true", dest="resume",
+                               help="Resume an interrupted run, skipping hostnames which were already processed")
+    journal_group.add_argument("--fresh", action="store_true", dest="fresh",
+                               help="Discard the journal of an interrupted run with other parameters")
+    parser.add_argument("--shard", type=shards.parse_shard, dest="shard",
+                        help="Only process shard i of N (0 <= i < N) and write a partial result for the merge command")
+    parser.add_argument("--partial-output", type=str, dest="partial_filename",
+                        help="Name of the partial result file in shard mode, default partial_<i>_of_<N>.json.gz")
+    parser.add_argument("--profile", type=str, dest="profile_dir",
+                        help="Profile each stage and write pstats, allocation and collapsed stack files to this directory")
+    parser.add_argument("--profile-interval", type=float, dest="profile_interval",
+                        default=profiling.SAMPLE_INTERVAL * 1000, help="Interval of stack samples in milliseconds")
+    parser.add_argument("--memory-report", action="store_true", dest="memory_report",
+                        help="Print the memory used by instances, caches and worker results compared to plain dicts")
+    parser.add_argument("--probe", action="store_true", dest="probe",
+                        help="Probe each instance via HTTP to detect CDNs and server software")
+    parser.add_argument("--probe-concurrency", type=int, dest="probe_concurrency", default=probe.PROBE_CONCURRENCY,
+                        help="Amount of parallel HTTP probes")
+    parser.add_argument("--probe-timeout", type=float, dest="probe_timeout", default=probe.PROBE_TIMEOUT,
+                        help="Timeout in seconds for each HTTP probe")
+
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser("merge", help="Merge the partial results of a sharded run into the reports")
+    merge_parser.add_argument("partial_files", nargs="+", metavar="PARTIAL", help="Partial result files of all shards")
+    merge_parser.add_argument("--output", type=str, dest="output_filename", default="analysis.csv",
+                              help="Name of CSV output file")
     args = parser.parse_args()
 
+    if args.profile_dir:
+        profiling.enable(args.profile_dir, args.profile_interval / 1000)
+
+    if args.command == "merge":
+        try:
+            with profiling.stage("merge"):
+                merged = shards.merge_partials([shards.read_partial(filename) for filename in args.partial_files])
+        except shards.PartialMismatch as e:
+            exit(str(e))
+        report(merged, args.output_filename)
+        profiling.finish()
+        exit(0)
+
     limit = args.instances_top_limit
 
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        exit("The sample fraction must be between 0 (exclusive) and 1")
+
     ip_networks_ipv4 = None
     ip_networks_ipv6 = None
 
-    if args.asn_ipv4:
-        ip_networks_ipv4 = ip2asn.asnfile_init(args.asn_ipv4)
-    if args.asn_ipv6:
-        ip_networks_ipv6 = ip2asn.asnfile_init(args.asn_ipv6)
+    with profiling.stage("asnfile_init"):
+        if args.asn_engine == "radix":
+            # One trie holds both address families, so both files may also contain mixed tables
+            asnames = ip2asn.asnames_init(args.asn_names) if args.asn_names else None
+            asn_files = [asn_file for asn_file in [args.asn_ipv4, args.asn_ipv6] if asn_file]
+            if asn_files:
+                ip_networks_ipv4 = ip_networks_ipv6 = ip2asn.prefixfiles_init(asn_files, asnames)
+        else:
+            if args.asn_ipv4:
+                ip_networks_ipv4 = ip2asn.asnfile_init(args.asn_ipv4)
+            if args.asn_ipv6:
+                ip_networks_ipv6 = ip2asn.asnfile_init(args.asn_ipv6)
+
     if not ip_networks_ipv4 and not ip_networks_ipv6:
         exit("Use at least one of --ipv4-list or --ipv6-list")
 
-    instances = read_instances(args.instances_list)["instances"]
-
-    cleaned: CleanupStats = cleanup_cachefiles()
-    print("Cleanup: {} IPs, {} no-IPs, {} ASNs".format(*cleaned))
+    raw_instances = read_instances(args.instances_list)["instances"]
+    raw_instances_size = profiling.deep_sizeof(raw_instances) if args.memory_report else 0
+    # Only keep the fields which are used, the full instances.social entries are dropped
+    instances = [records.instance_from_json(instance) for instance in raw_instances]
+    del raw_instances
+
+    with profiling.stage("cleanup_cachefiles"):
+        cleaned: CleanupStats = cleanup_cachefiles()
+        print("Cleanup: {} IPs, {} no-IPs, {} ASNs, {} probes".format(*cleaned))
+
+        if ip2asn.asnfile_changes[4] or ip2asn.asnfile_changes[6]:
+            print("Invalidated {} cached ASNs in changed ranges of the AS files".format(invalidate_asn_cache()))
+        if ip2asn.outdated_cachefiles:
+            # Save the invalidation before the caches of the previous AS files are removed. Otherwise an
+            # interrupted run would keep the outdated ASN cache entries, as the changes could not be found again.
+            with open(CACHEFILE_ASN, "w") as fh:
+                json.dump({hostname: records.asn_cache_to_json(entry) for hostname, entry in asn_cache.items()}, fh)
+            ip2asn.remove_outdated_cachefiles()
 
     if limit == 0:
         limit = len(instances)
 
-    # Run DNS resolution in multiple threads to bypass long-timed resolutions
-    # Run ASN mapping in multiple threads, involving dict lookup and conversion of types to IPAddress
-    counter = tqdm(desc="Analysing instances, running worker threads", total=limit, unit="instances")
-    pool = ThreadPool(NUM_WORKERS)
-    worker_results: [WorkerResult] = []
-
-    # To batch the worker payload, more than one hostname is passed to a worker to be processed.
-    # This also helps reducing the overhead for the progress bar, which uses locking for updates
-    hostname_batch = []
-
-    for instance in sorted(instances, key=lambda x: int(x["users"]), reverse=True)[:limit]:
-        hostname = instance["name"]
-        seen_instances[hostname] = instance
-
-        if hostname in no_ip_cache:
-            # Skip unresolvable hostnames, if they have failed in previous runs and are within a timeout limit
-            skipped_no_ip.append(instance)
-            counter.update()
-            continue
-
-        if hostname.startswith("you-think-your-fake"):
-            # Skip instances with faked statistics
-            counter.update()
-            continue
-
-        hostname_batch.append(hostname)
-
-        if len(hostname_batch) >= 10:
-            # Start full batch
-            worker_results.append(pool.apply_async(worker, args=(hostname_batch,)))
-            hostname_batch = []  # reset
-            continue
-
-    if len(hostname_batch):
-        # last items which do not fill a batch
-        worker_results.append(pool.apply_async(worker, args=(hostname_batch,)))
-
-    pool.close()
-    pool.join()
-    counter.close()
-
-    # Re-struct the results, fetching and unpacking each WorkerResult list from the thread result
-    worker_results = [] + [item for r in worker_results for item in r.get()]
-
-    # Map ASNs by hostname to a common name, removing duplicates
-    bar = tqdm(desc="Analysing instances, mapping ASNs", total=len(worker_results))
-    for wr in worker_results:
-        hostname = wr.hostname
-        instance = seen_instances[hostname]
-        bar.update()
-
-        if len(wr.v4) + len(wr.v6) == 0:
-            # print(f"No IPs found for instance {hostname}")
-            skipped_no_ip.append(instance)  # do this here to avoid problems with threaded access
-            no_ip_cache[hostname] = time.time()
-            continue
-
-        # Add the IP address resolution to the cache, if entry does not exist
-        if hostname not in ip_cache:
-            # timeout is handled before, after load from file
-            ip_cache[hostname] = {
-                "v4": wr.v4,
-                "v6": wr.v6,
-                "timestamp": time.time()
-            }
-
-        # Process ASN, either load from cache or proceed with examination
-        if len(wr.asn) == 0:
-            # print(f"ASN for {hostname} is of length 0")
-            skipped_no_asn.append(instance)
-            continue
-
-        # map ASNs to name cluster (merge multiple names for the same provider into one)
-        # using set() to remove duplicate network names
-        hoster = set([map_whois_to_hoster(item["name"]) for item in wr.asn])
-
-        if len(hoster) > 1:
-            # print(f"Instance {hostname} has more than one hosting ASN!")
-            # print("{name}:\t{networks}".format(name=hostname, networks=", ".join(hoster)))
-            skipped_multiple_asn.append(instance)
-            continue
-
-        hoster = hoster.pop()
-
-        if hoster is None:
-            skipped_unknown_mapping.append((instance, wr.asn[0]))
-            continue
-
-        if hostname not in asn_cache:
-            asn_cache[hostname] = {
-                "asn": [
-                    {"name": asn["name"],
-                     "asn": asn["asn"],
-                     "country": asn["country"],
-                     "start": asn["start"].exploded,
-                     "end": asn["end"].exploded
-                     } for asn in wr.asn],  # convert IP addresses back to strings for json.dump
-                "timestamp": time.time()
-            }
-
-        if hoster not in counters:
-            counters[hoster] = []
-        counters[hoster].append(hostname)
-
-        analysed_instances[hostname] = instance
-
-    bar.close()
-
-    # save caches to persistent files
-    with open(CACHEFILE_IP, "w") as fh:
-        json.dump(ip_cache, fh)
-    with open(CACHEFILE_NOIP, "w") as fh:
-        json.dump(no_ip_cache, fh)
-    with open(CACHEFILE_ASN, "w") as fh:
-        json.dump(asn_cache, fh)
-
-    if skipped_no_ip or skipped_no_asn or skipped_multiple_asn:
-        print(f"Skipped instances: {len(skipped_no_ip)} because of no IP (including cached), "
-              f"{len(skipped_no_asn)} because no ASN were found and "
-              f"{len(skipped_multiple_asn)} because multiple ASNs were found")
-
-    if skipped_unknown_mapping:
-        for instance, asn in skipped_unknown_mapping:
-            print(f"Instance {instance['name']} skipped because ASN '{asn['name']}' could not be mapped")
-
-    for new_hoster, asns in hoster_new_created.items():
-        if len(asns) > 1:
-            print(f"New hoster {new_hoster} created by multiple ASNs: {set(asns)} (total {len(asns)})")
-
-    x, y1, y2 = [], [], []
-
-    # Providers with 6-20 instances
-    medium_hosters_instances, medium_hosters_users = 0, 0
-    # Providers with 2-5 instances
-    small_hosters_instances, small_hosters_users = 0, 0
-    # At some point hosters will appear which only host one single instance. Merge them into one provider
-    single_hosters_instances, single_hoster_users = 0, 0
-
-    for hoster, hosted_instances in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
-        hosted_users = 0
-        for instance in hosted_instances:
-            hosted_users += int(analysed_instances[instance]["users"])
-
-        percent_instances = round(len(hosted_instances) / len(analysed_instances) * 100, 2)
-
-        hi = len(hosted_instances)
-
-        if hi == 1:
-            # Add values to cumulated "others" provider
-            single_hosters_instances += 1
-            single_hoster_users += hosted_users
-            continue
-
-        if hi <= 9:
-            small_hosters_instances += hi
-            small_hosters_users += hosted_users
-            continue
-
-        if hi <= 18:
-            medium_hosters_instances += hi
-            medium_hosters_users += hosted_users
-            continue
+    run_parameters = {
+        "instances_list": args.instances_list,
+        "limit": limit,
+        "asn_engine": args.asn_engine,
+        "asn_ipv4": args.asn_ipv4,
+        "asn_ipv6": args.asn_ipv6,
+        # A resumed run must not mix results of different versions of the AS files
+        "asn_ipv4_hash": args.asn_ipv4 and ip2asn.file_hash(args.asn_ipv4),
+        "asn_ipv6_hash": args.asn_ipv6 and ip2asn.file_hash(args.asn_ipv6),
+        "sample": args.sample_fraction,
+        "sample_seed": args.sample_seed,
+        "probe": args.probe
+    }
+
+    # Completed worker batches are appended to a journal, so that an interrupted run can be resumed
+    # Each shard has its own journal, so that shards can run in the same directory
+    journal = checkpoint.Journal(CHECKPOINT_FILE + ("_{}_of_{}".format(*args.shard) if args.shard else ""),
+                                 dict(run_parameters, shard=args.shard and list(args.shard)))
+    try:
+        journal.open(resume=args.resume, fresh=args.fresh)
+    except checkpoint.JournalMismatch as e:
+        exit(f"{e}\nResume it with the same parameters and --resume or discard it with --fresh")
 
-        # Hosters with >20 instances
-        x.append(f"{hoster} ({percent_instances}%)")
-        y1.append(len(hosted_instances))
-        y2.append(hosted_users)
+    # WorkerResults by hostname, pre-filled with the results of the interrupted run when resuming
+    completed_results = {}
+    if args.resume:
+        completed_results = {data["hostname"]: worker_result_from_json(data)
+                             for batch in journal.load() for data in batch}
+        print(f"Resuming with {len(completed_results)} hostnames from the interrupted run")
 
-    # Append medium hosters
-    x.append("(10-18)")
-    y1.append(medium_hosters_instances)
-    y2.append(medium_hosters_users)
+    # Run DNS resolution in multiple threads to bypass long-timed resolutions
+    # Run ASN mapping in multiple threads, involving dict lookup and conversion of types to IPAddress
+    # Instances are sorted and limited before sharding, so all shards together cover the same instances
+    # as a single-node run. The rank of each instance is kept to restore this order when merging.
+    selected_instances = sorted(instances, key=lambda x: x.users, reverse=True)[:limit]
+    instance_ranks = {instance.name: rank for rank, instance in enumerate(selected_instances)}
+
+    sampling_info = None
+    if args.sample_fraction:
+        selected_instances, population = sampling.stratified_sample(selected_instances, args.sample_fraction,
+                                                                    args.sample_seed)
+
+    if args.shard:
+        selected_instances = [instance for instance in selected_instances
+                              if shards.shard_of(instance.name, args.shard[1]) == args.shard[0]]
+
+    if args.sample_fraction:
+        # Sample sizes per stratum include instances which are skipped later, since they are part of the sample
+        sampled = {}
+        for instance in selected_instances:
+            stratum = sampling.stratum_of(instance.users)
+            sampled[stratum] = sampled.get(stratum, 0) + 1
+        sampling_info = {
+            "population": population,
+            "sampled": sampled,
+            "seed": args.sample_seed,
+            "bootstrap": args.bootstrap_replicates
+        }
+        print(f"Sampled {len(selected_instances)} of {sum(population.values())} instances in "
+              f"{len(population)} strata by user count")
+
+    with profiling.stage("worker_pool"):
+        counter = tqdm(desc="Analysing instances, running worker threads", total=len(selected_instances),
+                       unit="instances")
+        pool = ThreadPool(NUM_WORKERS)
+        worker_results: [WorkerResult] = []
+        # Hostnames passed on to the mapping, in order of the sorted instances list
+        queued_hostnames = []
+
+        def checkpoint_batch(results: [WorkerResult]):
+            journal.write([worker_result_to_json(wr) for wr in results])
+
+        # To batch the worker payload, more than one hostname is passed to a worker to be processed.
+        # This also helps reducing the overhead for the progress bar, which uses locking for updates
+        hostname_batch = []
+
+        for instance in selected_instances:
+            hostname = instance.name
+            seen_instances[hostname] = instance
+
+            if hostname in no_ip_cache:
+                # Skip unresolvable hostnames, if they have failed in previous runs and are within a timeout limit
+                skipped_no_ip.append(instance)
+                counter.update()
+                continue
 
-    # Append small hosters as single hoster
-    x.append("(2-9)")
-    y1.append(small_hosters_instances)
-    y2.append(small_hosters_users)
+            if hostname.startswith("you-think-your-fake"):
+                # Skip instances with faked statistics
+                counter.update()
+                continue
 
-    # At the end, add the "others" provider with the sum of hosted users
-    x.append("(1)")
-    y1.append(single_hosters_instances)
-    y2.append(single_hoster_users)
+            queued_hostnames.append(hostname)
 
-    # print(x, y1, y2)
-    plot_by_instances(x, y1, y2)
+            if hostname in completed_results:
+                # Already resolved and mapped in the interrupted run
+                counter.update()
+                continue
 
-    # Iterate again, this time sorting by users
-    # We cannot re-use the data above, since the aggregation of multiple providers into groups (single, small,
-    # medium) might hide big instances, which we would like to examine in this next step.
+            hostname_batch.append(hostname)
 
-    for user_category in ["users", "active_users"]:
-        hosters = {}
+            if len(hostname_batch) >= 10:
+                # Start full batch
+                worker_results.append(pool.apply_async(worker, args=(hostname_batch,), callback=checkpoint_batch))
+                hostname_batch = []  # reset
+                continue
 
-        # use if/else because dead instances don't have a value for active_users
-        total_users_fediverse = sum([int(insta[user_category] if insta[user_category] else 0)
-                                     for insta in analysed_instances.values()])
+        if len(hostname_batch):
+            # last items which do not fill a batch
+            worker_results.append(pool.apply_async(worker, args=(hostname_batch,), callback=checkpoint_batch))
+
+        pool.close()
+        pool.join()
+        counter.close()
+
+    print(f"Resolution: {resolution_stats['dns_queries']} DNS queries, "
+          f"{resolution_stats['known_targets']} hostnames taken from already resolved CNAME targets, "
+          f"{resolution_stats['asn_lookups']} ASN lookups for {resolution_stats['mapped_ips']} IPs "
+          f"({resolution_stats['mapped_ips'] - resolution_stats['asn_lookups']} saved)")
+
+    # Re-struct the results, fetching and unpacking each WorkerResult list from the thread result.
+    # Merged with resumed results in the order of the instances list, so the aggregation matches an uninterrupted run.
+    completed_results.update({item.hostname: item for r in worker_results for item in r.get()})
+    worker_results = [completed_results[hostname] for hostname in queued_hostnames]
+
+    with profiling.stage("hoster_mapping"):
+        # Map ASNs by hostname to a common name, removing duplicates
+        bar = tqdm(desc="Analysing instances, mapping ASNs", total=len(worker_results))
+        for wr in worker_results:
+            hostname = wr.hostname
+            instance = seen_instances[hostname]
+            bar.update()
+
+            if len(wr.v4) + len(wr.v6) == 0:
+                # print(f"No IPs found for instance {hostname}")
+                skipped_no_ip.append(instance)  # do this here to avoid problems with threaded access
+                no_ip_cache[hostname] = time.time()
+                continue
 
-        for hoster, hosted_instances in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
-            hosted_users = sum([int(analysed_instances[instance][user_category])  # amount
-                                if analysed_instances[instance][user_category] else 0  # if not None
-                                for instance in hosted_instances])  # for each instance at this provider
+            # Add the IP address resolution to the cache, if entry does not exist
+            if hostname not in ip_cache:
+                # timeout is handled before, after load from file
+                ip_cache[hostname] = records.IpCacheEntry(wr.v4, wr.v6, time.time())
 
-            percent_users = round(hosted_users / total_users_fediverse * 100, 2)
+            # Process ASN, either load from cache or proceed with examination
+            if len(wr.asn) == 0:
+                # print(f"ASN for {hostname} is of length 0")
+                skipped_no_asn.append(instance)
+                continue
 
-            hosters[f"{hoster} ({percent_users}%)"] = {
-                "users": hosted_users,
-                "instances": len(hosted_instances)
-            }
+            # map ASNs to name cluster (merge multiple names for the same provider into one)
+            # using set() to remove duplicate network names
+            hoster = set([map_whois_to_hoster(item.name) for item in wr.asn])
 
-        x, y1, y2 = [], [], []  # reset
+            if len(hoster) > 1:
+                # print(f"Instance {hostname} has more than one hosting ASN!")
+                # print("{name}:\t{networks}".format(name=hostname, networks=", ".join(hoster)))
+                skipped_multiple_asn.append(instance)
+                continue
 
-        others = 0
-        others_users = 0
-        others_instances = 0
+            hoster = hoster.pop()
 
-        total_users = 0
-        total_instances = 0
+            if hoster is None:
+                skipped_unknown_mapping.append((instance, wr.asn[0]))
+                continue
 
-        for hoster, data in sorted(hosters.items(), key=lambda x: x[1]["users"], reverse=True):
-            hosted_users = data["users"]
-            hosted_instances = data["instances"]
+            if hostname not in asn_cache:
+                asn_cache[hostname] = records.AsnCacheEntry(wr.asn, time.time())
 
-            total_users += hosted_users
-            total_instances += hosted_instances
+            if hoster not in counters:
+                counters[hoster] = []
+            counters[hoster].append(hostname)
 
-            if len(x) >= 20:
-                others += 1
-                others_users += hosted_users
-                others_instances += hosted_instances
-                continue
+            analysed_instances[hostname] = instance
 
-            x.append(hoster)
-            y1.append(hosted_users)
-            y2.append(hosted_instances)
-
-        x.append("Others ({})".format(others))
-        y1.append(others_users)
-        y2.append(others_instances)
-        plot_by_users(x, y1, y2) if user_category == "users" else plot_by_active_users(x, y1, y2)
-
-    # Markdown export hack
-    print("\n\nMarkdown export\n\n| Hoster | Users | U% | Instances | I% |")
-    print("|" + "---|" * 5)
-    lines = 0
-    for hoster, data in sorted(hosters.items(), key=lambda x: x[1]["users"], reverse=True):
-        if lines > 20:
-            break
-        hosted_users = data["users"]
-        hosted_instances = data["instances"]
-
-        print("| {hoster} | {users} | {users_p}% | {instances} | {instances_p}% |".format(
-            hoster=hoster,
-            users=hosted_users, users_p=round(hosted_users/total_users*100, 2),
-            instances=hosted_instances, instances_p=round(hosted_instances/total_instances*100, 2)
-        ))
-        lines += 1
-
-    print(f"\n\nWriting CSV file to {args.output_filename}")
-    with open(args.output_filename, "w") as fh:
-        csvwriter = csv.writer(fh, delimiter=',')
-        csvwriter.writerow(["instance",
-                            "users", "active_users",
-                            "statuses", "connections",
-                            "ipv6", "hoster",
-                            "hosted_instances", "percent_instances",
-                            "hosted_users", "percent_users"])
-
-        for hoster, hostnames in sorted(counters.items(), key=lambda x: len(x[1]), reverse=True):
-            hosted_users = 0
-            for hostname in hostnames:
-                hosted_users += int(analysed_instances[hostname]["users"])
+        bar.close()
 
-            percent_users = round(hosted_users / total_users * 100, 3)
-            percent_instances = round(len(hostnames) / len(analysed_instances) * 100, 3)
-            # print(hoster, len(hostnames), round(len(hostnames) / len(analysed_instances) * 100, 3),
-            #       hosted_users, percent_users)
-            for hostname in hostnames:
-                csvwriter.writerow([
-                    hostname,
-                    analysed_instances[hostname]["users"], analysed_instances[hostname]["active_users"],
-                    analysed_instances[hostname]["statuses"], analysed_instances[hostname]["connections"],
-                    analysed_instances[hostname]["ipv6"], hoster,
-                    len(hostnames), percent_instances,
-                    hosted_users, percent_users])
+    if args.probe:
+        # Fetch the instance API of each analysed instance to find out which of them are fronted by a CDN.
+        # In this case the ASN belongs to the CDN and not to the hoster of the origin server.
+        with profiling.stage("probing"):
+            probe_results = probe.probe_instances(list(analysed_instances), probe_cache,
+                                                  concurrency=args.probe_concurrency, timeout=args.probe_timeout)
 
-    # experiment 1: check IPs which host more than 10 instances
-    ip_groups = experiments.check_multihost(ip_cache, asn_cache)
-    for ip, data in sorted(ip_groups.items(), key=lambda x: len(x[1]["instances"]), reverse=True)[:5]:
-        hoster = data["as"]
-        hostnames = data["instances"]
-        if len(hostnames) > 10:
-            print(f"\nIP {ip} ({hoster}) hosts {len(hostnames)} instances: {hostnames}")
+    # save caches to persistent files
+    with open(CACHEFILE_IP, "w") as fh:
+        json.dump({hostname: records.ip_cache_to_json(entry) for hostname, entry in ip_cache.items()}, fh)
+    with open(CACHEFILE_NOIP, "w") as fh:
+        json.dump(no_ip_cache, fh)
+    with open(CACHEFILE_ASN, "w") as fh:
+        json.dump({hostname: records.asn_cache_to_json(entry) for hostname, entry in asn_cache.items()}, fh)
+    if args.probe:
+        with open(CACHEFILE_PROBE, "w") as fh:
+            json.dump(probe_cache, fh)
+
+    # All results are persisted in the caches, the journal is not needed anymore
+    journal.remove()
+
+    if args.memory_report:
+        print_memory_report(raw_instances_size, instances, worker_results)
+
+    shard = args.shard or (0, 1)
+    with profiling.stage("check_multihost"):
+        ip_groups = experiments.check_multihost(shards.filter_cache(ip_cache, shard),
+                                                shards.filter_cache(asn_cache, shard))
+
+    partial = shards.build_partial(run_parameters, shard, instance_ranks, counters, analysed_instances,
+                                   skipped_no_ip, skipped_no_asn, skipped_multiple_asn, skipped_unknown_mapping,
+                                   hoster_new_created, probe_results, ip_groups, sampling_info)
+
+    if args.shard:
+        # The reports are created by the merge subcommand once all shards are done
+        partial_filename = args.partial_filename or "partial_{}_of_{}.json.gz".format(*args.shard)
+        shards.write_partial(partial_filename, partial)
+        print(f"Wrote partial result of shard {args.shard[0]}/{args.shard[1]} to {partial_filename}")
+    else:
+        # A single-node run is merged from one partial as well, so both produce the same reports
+        report(shards.merge_partials([partial]), args.output_filename)
+
+    profiling.finish()
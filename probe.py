@@ -0,0 +1,281 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+import ssl
+import time
+from collections import namedtuple, OrderedDict
+from typing import Dict, Optional
+from urllib.parse import urljoin, urlsplit
+
+from tqdm import tqdm
+
+PROBE_PATH = "/api/v1/instance"
+PROBE_CONCURRENCY = 256
+PROBE_PER_HOST = 2
+PROBE_TIMEOUT = 10.0
+MAX_REDIRECTS = 3
+MAX_IDLE_CONNECTIONS = 256  # each instance is a different host, so idle connections are rarely reused
+MAX_BODY_SIZE = 1024 * 1024  # 1 MiB, the instance API response is usually a few kB
+
+# Response headers which are only set by a specific CDN
+CDN_HEADERS = {
+    "cf-ray": "cloudflare",
+    "cf-cache-status": "cloudflare",
+    "x-amz-cf-id": "cloudfront",
+    "x-amz-cf-pop": "cloudfront",
+    "x-fastly-request-id": "fastly",
+    "fastly-debug-digest": "fastly",
+    "x-akamai-transformed": "akamai",
+    "akamai-grn": "akamai",
+    "x-sucuri-id": "sucuri",
+    "x-azure-ref": "azure",
+    "x-77-cache": "cdn77",
+    "cdn-pullzone": "bunnycdn",
+}
+
+# Substrings of the "Server" header which identify a CDN instead of the origin web server
+CDN_SERVERS = {
+    "cloudflare": "cloudflare",
+    "cloudfront": "cloudfront",
+    "akamaighost": "akamai",
+    "bunnycdn": "bunnycdn",
+    "keycdn": "keycdn",
+    "ddos-guard": "ddos-guard",
+    "sucuri": "sucuri",
+}
+
+ProbeResult = namedtuple('ProbeResult', ['hostname', 'status', 'server', 'cdn', 'version', 'error'])
+HttpResponse = namedtuple('HttpResponse', ['status', 'headers', 'body', 'keep_alive'])
+
+
+class ConnectionPool:
+    """
+    Pool of keep-alive HTTP/1.1 connections, keyed by (host, port, tls).
+    The total amount of open requests and the amount of parallel requests per host are limited by semaphores.
+    At most MAX_IDLE_CONNECTIONS idle connections are kept, the least recently used ones are closed first.
+    """
+
+    def __init__(self, concurrency: int = PROBE_CONCURRENCY, per_host: int = PROBE_PER_HOST,
+                 timeout: float = PROBE_TIMEOUT, ssl_context: Optional[ssl.SSLContext] = None):
+        self.timeout = timeout
+        self.per_host = per_host
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._global = asyncio.Semaphore(concurrency)
+        self._host_limits: Dict[tuple, asyncio.Semaphore] = {}
+        self._idle: Dict[tuple, list] = OrderedDict()
+        self._idle_count = 0
+
+    async def request(self, scheme: str, host: str, port: int, path: str) -> HttpResponse:
+        key = (host, port, scheme == "https")
+        if key not in self._host_limits:
+            self._host_limits[key] = asyncio.Semaphore(self.per_host)
+
+        # Waiting for a busy host must not block one of the global slots
+        async with self._host_limits[key], self._global:
+            return await asyncio.wait_for(self._request(key, path), self.timeout)
+
+    async def _request(self, key: tuple, path: str) -> HttpResponse:
+        # A pooled connection might have been closed by the server in the meantime, retry once on a fresh one
+        for reused in (True, False):
+            reader, writer, is_pooled = await self._acquire(key, reuse=reused)
+            try:
+                response = await _exchange(reader, writer, key[0], path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if is_pooled:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if response.keep_alive:
+                self._release(key, reader, writer)
+            else:
+                writer.close()
+            return response
+
+    def _release(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._idle.setdefault(key, []).append((reader, writer))
+        self._idle.move_to_end(key)
+        self._idle_count += 1
+        while self._idle_count > MAX_IDLE_CONNECTIONS:
+            oldest_key = next(iter(self._idle))
+            connections = self._idle[oldest_key]
+            connections.pop(0)[1].close()
+            self._idle_count -= 1
+            if not connections:
+                del self._idle[oldest_key]
+
+    async def _acquire(self, key: tuple, reuse: bool) -> tuple:
+        idle = self._idle.get(key)
+        while reuse and idle:
+            reader, writer = idle.pop()
+            self._idle_count -= 1
+            if not idle:
+                del self._idle[key]
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        host, port, tls = key
+        reader, writer = await asyncio.open_connection(host, port, ssl=self.ssl_context if tls else None,
+                                                       server_hostname=host if tls else None)
+        return reader, writer, False
+
+    def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+        self._idle_count = 0
+
+
+async def _exchange(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str,
+                    path: str) -> HttpResponse:
+    writer.write((f"GET {path} HTTP/1.1\r\n"
+                  f"Host: {host}\r\n"
+                  f"User-Agent: fediverse-infra-analysis\r\n"
+                  f"Accept: application/json\r\n"
+                  f"Connection: keep-alive\r\n\r\n").encode("ascii"))
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed before response")
+    version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        # Multiple headers of the same name are joined, as allowed by RFC 7230
+        headers[name] = headers[name] + ", " + value.strip() if name in headers else value.strip()
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)  # CRLF after each chunk
+            if len(body) > MAX_BODY_SIZE:
+                raise ValueError("Response body too large")
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+        if length > MAX_BODY_SIZE:
+            raise ValueError("Response body too large")
+        body = await reader.readexactly(length)
+    else:
+        # No framing, the body ends when the server closes the connection
+        body = await reader.read(MAX_BODY_SIZE)
+        keep_alive = False
+
+    return HttpResponse(int(status), headers, body, keep_alive)
+
+
+def detect_cdn(headers: dict) -> Optional[str]:
+    for header, cdn in CDN_HEADERS.items():
+        if header in headers:
+            return cdn
+
+    server = headers.get("server", "").lower()
+    for name, cdn in CDN_SERVERS.items():
+        if name in server:
+            return cdn
+
+    return None
+
+
+async def probe_host(pool: ConnectionPool, hostname: str, scheme: str = "https",
+                     port: Optional[int] = None) -> ProbeResult:
+    url = f"{scheme}://{hostname}{':' + str(port) if port else ''}{PROBE_PATH}"
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            target = urlsplit(url)
+            port = target.port or (443 if target.scheme == "https" else 80)
+            path = target.path + ("?" + target.query if target.query else "")
+            response = await pool.request(target.scheme, target.hostname, port, path or "/")
+
+            if response.status in (301, 302, 303, 307, 308) and "location" in response.headers:
+                # Resolve relative redirects against the current URL
+                url = urljoin(url, response.headers["location"])
+                continue
+            break
+    except (OSError, asyncio.TimeoutError, ValueError, asyncio.IncompleteReadError) as e:
+        return ProbeResult(hostname, None, None, None, None, type(e).__name__)
+
+    version = None
+    if response.status == 200:
+        try:
+            version = json.loads(response.body).get("version")
+        except (ValueError, AttributeError):
+            pass
+
+    return ProbeResult(hostname, response.status, response.headers.get("server"),
+                       detect_cdn(response.headers), version, None)
+
+
+async def probe_hosts(hostnames: list, concurrency: int = PROBE_CONCURRENCY, per_host: int = PROBE_PER_HOST,
+                      timeout: float = PROBE_TIMEOUT, scheme: str = "https", port: Optional[int] = None,
+                      ssl_context: Optional[ssl.SSLContext] = None) -> Dict[str, ProbeResult]:
+    pool = ConnectionPool(concurrency, per_host, timeout, ssl_context)
+    bar = tqdm(desc="Probing instances via HTTP", total=len(hostnames), unit="instances")
+
+    async def run(hostname: str) -> ProbeResult:
+        result = await probe_host(pool, hostname, scheme, port)
+        bar.update()
+        return result
+
+    try:
+        results = await asyncio.gather(*[run(hostname) for hostname in hostnames])
+    finally:
+        pool.close()
+        bar.close()
+
+    return {result.hostname: result for result in results}
+
+
+def probe_instances(hostnames: list, probe_cache: dict, **kwargs) -> Dict[str, dict]:
+    """
+    Probe all hostnames which are not yet in the probe cache and add the results to it.
+    :param hostnames: list of instance hostnames
+    :param probe_cache: dict of hostname to cached probe result, updated in place
+    :param kwargs: passed on to probe_hosts
+    :return: probe results for all hostnames, either from cache or freshly probed
+    """
+    missing = [hostname for hostname in hostnames if hostname not in probe_cache]
+    if missing:
+        for hostname, result in asyncio.run(probe_hosts(missing, **kwargs)).items():
+            entry = result._asdict()
+            del entry["hostname"]
+            entry["timestamp"] = time.time()
+            probe_cache[hostname] = entry
+
+    return {hostname: probe_cache[hostname] for hostname in hostnames}
@@ -0,0 +1,165 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import cProfile
+import os
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.01  # seconds between stack samples
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 1  # more frames give better tracebacks, but slow down every allocation
+
+_output_dir = None
+_sampler = None
+_summary = []
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of all threads in a fixed interval and counts them in the collapsed stack format
+    of flamegraph.pl ("stage;thread;frame;frame count"). The overhead depends only on the interval,
+    not on the amount of function calls, so it also covers the worker threads at low cost.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.stage = "main"
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)).replace(" ", "_"))
+                stack.append(self.stage)
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    """
+    Size of an object including all objects it references through containers. Objects which are referenced
+    multiple times, like interned strings, are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def enable(output_dir: str, interval: float = SAMPLE_INTERVAL):
+    """
+    Enable profiling of all following stages, writing the reports to output_dir
+    """
+    global _output_dir, _sampler
+    os.makedirs(output_dir, exist_ok=True)
+    _output_dir = output_dir
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    _sampler = StackSampler(interval)
+    _sampler.start()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Profile a pipeline stage with cProfile and tracemalloc. Does nothing if profiling is not enabled.
+    Writes <name>.pstats and <name>.alloc.txt with the peak memory and the top allocation sites of the stage.
+    """
+    if _output_dir is None:
+        yield
+        return
+
+    previous_stage = _sampler.stage
+    _sampler.stage = name
+    if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+        tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    profiler = cProfile.Profile()
+    started = time.time()
+
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        duration = time.time() - started
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        _sampler.stage = previous_stage
+
+        profiler.dump_stats(os.path.join(_output_dir, "{}.pstats".format(name)))
+
+        with open(os.path.join(_output_dir, "{}.alloc.txt".format(name)), "w") as fh:
+            fh.write("Stage {}: {:.3f}s, peak memory {:.1f} MiB, current memory {:.1f} MiB\n\n".format(
+                name, duration, peak / 2 ** 20, current / 2 ** 20))
+            fh.write("Top {} allocation sites (difference to the start of the stage):\n".format(TOP_ALLOCATIONS))
+            for statistic in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]:
+                fh.write("{}\n".format(statistic))
+
+        _summary.append((name, duration, peak))
+
+
+def finish():
+    """
+    Stop profiling and write the collapsed stacks and the summary of all stages
+    """
+    global _output_dir, _sampler
+    if _output_dir is None:
+        return
+
+    _sampler.stop()
+    tracemalloc.stop()
+
+    with open(os.path.join(_output_dir, "stacks.collapsed"), "w") as fh:
+        for stack, count in sorted(_sampler.stacks.items()):
+            fh.write("{} {}\n".format(stack, count))
+
+    with open(os.path.join(_output_dir, "summary.txt"), "w") as fh:
+        fh.write("{:<20} {:>10} {:>15}\n".format("stage", "seconds", "peak MiB"))
+        for name, duration, peak in _summary:
+            fh.write("{:<20} {:>10.3f} {:>15.1f}\n".format(name, duration, peak / 2 ** 20))
+
+    print(f"Profiling reports written to {_output_dir}")
+    _output_dir, _sampler = None, None
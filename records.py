@@ -0,0 +1,111 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Compact in-memory records for instances, cache entries and AS networks. All records are namedtuples, which
+have empty __slots__ and store their fields in a tuple instead of a per-object dict. IP addresses are stored
+as integers, AS names and countries are interned in a shared string table. The JSON formats of the cache files
+stay the same, conversion happens when loading and saving.
+"""
+
+import ipaddress
+from collections import namedtuple
+
+# Only the fields of instances.social entries which are used by the analysis
+Instance = namedtuple('Instance', ['name', 'users', 'active_users', 'statuses', 'connections', 'ipv6'])
+
+# An AS network an IP belongs to. start and end are integers of IP version "version".
+AsNetwork = namedtuple('AsNetwork', ['asn', 'name', 'country', 'version', 'start', 'end'])
+
+IpCacheEntry = namedtuple('IpCacheEntry', ['v4', 'v6', 'timestamp'])
+AsnCacheEntry = namedtuple('AsnCacheEntry', ['asn', 'timestamp'])
+
+_string_table = {}
+
+_ADDRESS_CLASSES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+
+def intern(value: str) -> str:
+    """
+    Return the shared instance of a string, so that repeated AS names and countries are stored once.
+    dict.setdefault is atomic, so this is safe to call from the worker threads.
+    """
+    return _string_table.setdefault(value, value)
+
+
+def string_table_size() -> int:
+    return len(_string_table)
+
+
+def ip_to_str(version: int, ip: int) -> str:
+    return str(_ADDRESS_CLASSES[version](ip))
+
+
+def ip_to_address(version: int, ip: int) -> [ipaddress.IPv4Address, ipaddress.IPv6Address]:
+    return _ADDRESS_CLASSES[version](ip)
+
+
+def instance_from_json(data: dict) -> Instance:
+    # users are used for sorting and summing, so they are converted once here
+    return Instance(data["name"], int(data["users"]),
+                    int(data["active_users"]) if data["active_users"] else data["active_users"],
+                    data["statuses"], data["connections"], data["ipv6"])
+
+
+def as_network(network: dict) -> AsNetwork:
+    """
+    Convert a network dict, as returned by ip2asn.get_asn_of_ip or stored in the caches, to an AsNetwork
+    """
+    start, end = network["start"], network["end"]
+    if isinstance(start, str):
+        start, end = ipaddress.ip_address(start), ipaddress.ip_address(end)
+    return AsNetwork(network["asn"], intern(network["name"]), intern(network["country"]), start.version,
+                     int(start), int(end))
+
+
+def as_network_to_json(network: AsNetwork) -> dict:
+    return {
+        "name": network.name,
+        "asn": network.asn,
+        "country": network.country,
+        "start": ip_to_address(network.version, network.start).exploded,
+        "end": ip_to_address(network.version, network.end).exploded
+    }
+
+
+def ip_cache_from_json(data: dict) -> IpCacheEntry:
+    return IpCacheEntry(tuple(int(ipaddress.IPv4Address(ip)) for ip in data["v4"]),
+                        tuple(int(ipaddress.IPv6Address(ip)) for ip in data["v6"]),
+                        data["timestamp"])
+
+
+def ip_cache_to_json(entry: IpCacheEntry) -> dict:
+    return {
+        "v4": [ip_to_str(4, ip) for ip in entry.v4],
+        "v6": [ip_to_str(6, ip) for ip in entry.v6],
+        "timestamp": entry.timestamp
+    }
+
+
+def asn_cache_from_json(data: dict) -> AsnCacheEntry:
+    return AsnCacheEntry(tuple(as_network(network) for network in data["asn"]), data["timestamp"])
+
+
+def asn_cache_to_json(entry: AsnCacheEntry) -> dict:
+    return {
+        "asn": [as_network_to_json(network) for network in entry.asn],
+        "timestamp": entry.timestamp
+    }
@@ -0,0 +1,135 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import random
+from collections import namedtuple
+from typing import Dict, List
+
+import numpy as np
+
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_BLOCK = 100  # replicates drawn at once, limits the memory of the index matrix
+CONFIDENCE = 0.95
+
+Estimate = namedtuple('Estimate', ['hoster', 'sampled_instances',
+                                   'instances', 'instances_low', 'instances_high',
+                                   'users', 'users_low', 'users_high'])
+
+
+def stratum_of(users: [str, int, None]) -> int:
+    """
+    Bucket of an instance by its user count in powers of ten: 0 users, 1-9, 10-99, 100-999, ...
+    """
+    users = int(users or 0)
+    return 0 if users <= 0 else len(str(users))
+
+
+def stratum_label(stratum: int) -> str:
+    return "0" if stratum == 0 else "{}-{}".format(10 ** (stratum - 1), 10 ** stratum - 1)
+
+
+def stratified_sample(instances: list, fraction: float, seed: int) -> tuple:
+    """
+    Draw the same fraction of instances from each user count bucket, at least one per bucket.
+    Small instances are the majority, so a simple random sample would hardly contain any large instances.
+    :param instances: list of instances, the order is kept in the sample
+    :param fraction: share of instances to sample, 0 < fraction <= 1
+    :param seed: seed for the random choice, must be the same for all shards of a run
+    :return: tuple of (sampled instances, dict of stratum to number of instances in the population)
+    """
+    rng = random.Random(seed)
+    strata: Dict[int, List[int]] = {}
+    for position, instance in enumerate(instances):
+        strata.setdefault(stratum_of(instance.users), []).append(position)
+
+    chosen = set()
+    for stratum, positions in sorted(strata.items()):
+        size = min(len(positions), max(1, round(fraction * len(positions))))
+        chosen.update(rng.sample(positions, size))
+
+    sample = [instance for position, instance in enumerate(instances) if position in chosen]
+    return sample, {stratum: len(positions) for stratum, positions in strata.items()}
+
+
+def estimate_shares(counters: dict, analysed_instances: dict, population: Dict[int, int], sampled: Dict[int, int],
+                    replicates: int = BOOTSTRAP_REPLICATES, seed: int = 0) -> List[Estimate]:
+    """
+    Estimate the share of instances and users per hoster in the population from a stratified sample.
+    Each sampled instance is weighted by the inverse sampling rate of its stratum. Confidence intervals are
+    percentiles of a stratified bootstrap, resampling the sampled instances of each stratum with replacement.
+    Sampled instances which were skipped (no IP, no ASN, ...) stay in the resampling, but count for no hoster.
+    :param counters: dict of hoster to list of analysed hostnames in the sample
+    :param analysed_instances: dict of hostname to instance
+    :param population: dict of stratum to number of instances in the population
+    :param sampled: dict of stratum to number of sampled instances, including skipped ones
+    :param replicates: number of bootstrap replicates
+    :param seed: seed for the bootstrap
+    :return: list of Estimate, shares in percent, sorted by users share
+    """
+    hosters = list(counters)
+    other = len(hosters)  # column for sampled instances which were not analysed
+    columns = other + 1
+
+    members: Dict[int, list] = {stratum: [] for stratum in sampled}
+    for column, hoster in enumerate(hosters):
+        for hostname in counters[hoster]:
+            users = analysed_instances[hostname].users or 0
+            members[stratum_of(users)].append((column, users))
+
+    rng = np.random.default_rng(seed)
+    point_instances, point_users = np.zeros(columns), np.zeros(columns)
+    boot_instances, boot_users = np.zeros((replicates, columns)), np.zeros((replicates, columns))
+
+    for stratum, size in sampled.items():
+        stratum_members = members[stratum] + [(other, 0)] * (size - len(members[stratum]))
+        if not stratum_members:
+            continue
+        hoster_columns = np.array([column for column, _ in stratum_members])
+        users = np.array([users for _, users in stratum_members], dtype=float)
+        weight = population[stratum] / len(stratum_members)
+
+        point_instances += np.bincount(hoster_columns, minlength=columns) * weight
+        point_users += np.bincount(hoster_columns, weights=users, minlength=columns) * weight
+
+        for start in range(0, replicates, BOOTSTRAP_BLOCK):
+            block = min(BOOTSTRAP_BLOCK, replicates - start)
+            draws = rng.integers(0, len(stratum_members), size=(block, len(stratum_members)))
+            # Offset the hoster column of each replicate, so one bincount covers the whole block
+            flat = (hoster_columns[draws] + np.arange(block)[:, None] * columns).ravel()
+            boot_instances[start:start + block] += np.bincount(
+                flat, minlength=block * columns).reshape(block, columns) * weight
+            boot_users[start:start + block] += np.bincount(
+                flat, weights=users[draws].ravel(), minlength=block * columns).reshape(block, columns) * weight
+
+    def shares(totals: np.ndarray) -> np.ndarray:
+        totals = totals[..., :other]
+        sums = totals.sum(axis=-1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nan_to_num(totals / sums) * 100
+
+    tail = (1 - CONFIDENCE) / 2 * 100
+    instances, users = shares(point_instances), shares(point_users)
+    instances_low, instances_high = np.percentile(shares(boot_instances), [tail, 100 - tail], axis=0)
+    users_low, users_high = np.percentile(shares(boot_users), [tail, 100 - tail], axis=0)
+
+    estimates = [Estimate(hoster, len(counters[hoster]),
+                          round(instances[column], 3), round(instances_low[column], 3),
+                          round(instances_high[column], 3),
+                          round(users[column], 3), round(users_low[column], 3), round(users_high[column], 3))
+                 for column, hoster in enumerate(hosters)]
+    return sorted(estimates, key=lambda e: e.users, reverse=True)
@@ -0,0 +1,196 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+from collections import namedtuple
+from typing import Dict, Any, Optional
+
+import records
+
+
+PARTIAL_VERSION = 1
+
+# Fields of instances.social entries which are used in the reports
+INSTANCE_FIELDS = ["users", "active_users", "statuses", "connections", "ipv6"]
+
+MergedResult = namedtuple('MergedResult', ['counters', 'analysed_instances',
+                                           'skipped_no_ip', 'skipped_no_asn', 'skipped_multiple_asn',
+                                           'skipped_unknown_mapping', 'hoster_new_created',
+                                           'probe_results', 'ip_groups', 'sampling'])
+
+
+class PartialMismatch(Exception):
+    pass
+
+
+def parse_shard(value: str) -> tuple:
+    """
+    Parse a shard specification "i/N" with 0 <= i < N, used as argparse type.
+    """
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard must be given as i/N, e.g. 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("Shard index must be between 0 and N-1")
+    return index, count
+
+
+def shard_of(hostname: str, count: int) -> int:
+    # Python's hash() is randomized per process, so a stable hash is needed for all nodes to agree
+    return int.from_bytes(hashlib.sha1(hostname.encode("utf-8")).digest()[:8], "big") % count
+
+
+def filter_cache(cache: dict, shard: tuple) -> dict:
+    """
+    Only the cache entries of a shard are used, the caches of a node may also hold entries of other shards
+    """
+    index, count = shard
+    return {hostname: data for hostname, data in cache.items() if shard_of(hostname, count) == index}
+
+
+def build_partial(run: dict, shard: tuple, ranks: Dict[str, int], counters: dict, analysed_instances: dict,
+                  skipped_no_ip: list, skipped_no_asn: list, skipped_multiple_asn: list,
+                  skipped_unknown_mapping: list, hoster_new_created: dict, probe_results: dict,
+                  ip_groups: dict, sampling_info: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Compact, JSON serializable result of a (sharded) run, which can be merged with the partials of other shards.
+    Instances are stored with their rank in the sorted instances list, so the merge restores the order of a
+    single-node run.
+    :param run: parameters of the run, must be equal for all merged partials
+    :param shard: tuple of (index, count)
+    :param ranks: dict of hostname to position in the sorted instances list
+    :param ip_groups: result of experiments.check_multihost for the cache entries of this shard
+    :param sampling_info: population and sample sizes per stratum, if the run analysed a sample
+    :return: dict
+    """
+    hosters = {}
+    for hoster, hostnames in counters.items():
+        instances = [[ranks[hostname], hostname] + [getattr(analysed_instances[hostname], field)
+                                                    for field in INSTANCE_FIELDS]
+                     for hostname in hostnames]
+        hosters[hoster] = {
+            "instances": instances,
+            "users": sum(analysed_instances[hostname].users for hostname in hostnames),
+            "active_users": sum(analysed_instances[hostname].active_users or 0 for hostname in hostnames)
+        }
+
+    return {
+        "version": PARTIAL_VERSION,
+        "run": run,
+        "shard": list(shard),
+        "hosters": hosters,
+        "skipped": {
+            "no_ip": [instance.name for instance in skipped_no_ip],
+            "no_asn": [instance.name for instance in skipped_no_asn],
+            "multiple_asn": [instance.name for instance in skipped_multiple_asn],
+            "unknown_mapping": [[ranks[instance.name], instance.name, asn.name]
+                                for instance, asn in skipped_unknown_mapping]
+        },
+        "new_hosters": hoster_new_created,
+        "probe": probe_results,
+        "multihost": {ip: {"as": data["as"], "instances": sorted(data["instances"])}
+                      for ip, data in ip_groups.items()},
+        "sampling": sampling_info
+    }
+
+
+def write_partial(filename: str, partial: dict):
+    with gzip.open(filename, "wt") as fh:
+        json.dump(partial, fh)
+
+
+def read_partial(filename: str) -> dict:
+    with gzip.open(filename, "rt") as fh:
+        partial = json.load(fh)
+    if partial.get("version") != PARTIAL_VERSION:
+        raise PartialMismatch("Partial {} has unsupported version {}".format(filename, partial.get("version")))
+    return partial
+
+
+def merge_partials(partials: list) -> MergedResult:
+    """
+    Combine partials into the data structures of a single-node run.
+    :param partials: list of partial dicts, in any order
+    :return: MergedResult
+    :raises PartialMismatch: if the partials belong to different runs or a shard is given twice
+    """
+    if not partials:
+        raise PartialMismatch("No partials to merge")
+
+    run, count = partials[0]["run"], partials[0]["shard"][1]
+    indices = set()
+    for partial in partials:
+        if partial["run"] != run or partial["shard"][1] != count:
+            raise PartialMismatch("Partials belong to different runs: {} and {}".format(run, partial["run"]))
+        if partial["shard"][0] in indices:
+            raise PartialMismatch("Shard {}/{} is given more than once".format(*partial["shard"]))
+        indices.add(partial["shard"][0])
+
+    missing = set(range(count)) - indices
+    if missing:
+        print("Warning: shards {} of {} are missing, the results are incomplete".format(sorted(missing), count))
+
+    partials = sorted(partials, key=lambda p: p["shard"][0])
+
+    # Re-create the insertion order of the single-node run: hosters in order of their first instance by rank,
+    # instances of each hoster by rank
+    rows = sorted((row[0], hoster, row) for partial in partials
+                  for hoster, data in partial["hosters"].items() for row in data["instances"])
+    counters = {}
+    analysed_instances = {}
+    for _, hoster, row in rows:
+        hostname = row[1]
+        counters.setdefault(hoster, []).append(hostname)
+        analysed_instances[hostname] = records.Instance(*row[1:])
+
+    skipped_no_ip, skipped_no_asn, skipped_multiple_asn, skipped_unknown_mapping = [], [], [], []
+    hoster_new_created = {}
+    probe_results = {}
+    multihost = {}
+    for partial in partials:
+        skipped_no_ip += partial["skipped"]["no_ip"]
+        skipped_no_asn += partial["skipped"]["no_asn"]
+        skipped_multiple_asn += partial["skipped"]["multiple_asn"]
+        skipped_unknown_mapping += partial["skipped"]["unknown_mapping"]
+        for hoster, asns in partial["new_hosters"].items():
+            hoster_new_created.setdefault(hoster, []).extend(asns)
+        probe_results.update(partial["probe"])
+        for ip, data in partial["multihost"].items():
+            if ip not in multihost:
+                multihost[ip] = {"as": data["as"], "instances": set()}
+            multihost[ip]["instances"].update(data["instances"])
+
+    # The population is the same for all shards, the sample sizes are split across the shards.
+    # JSON turned the strata into string keys.
+    sampling_info = None
+    if partials[0]["sampling"]:
+        sampling_info = dict(partials[0]["sampling"], sampled={})
+        sampling_info["population"] = {int(stratum): size
+                                       for stratum, size in sampling_info["population"].items()}
+        for partial in partials:
+            for stratum, size in partial["sampling"]["sampled"].items():
+                sampling_info["sampled"][int(stratum)] = sampling_info["sampled"].get(int(stratum), 0) + size
+
+    skipped_unknown_mapping = [(hostname, asn_name) for _, hostname, asn_name in sorted(skipped_unknown_mapping)]
+
+    return MergedResult(counters, analysed_instances, skipped_no_ip, skipped_no_asn, skipped_multiple_asn,
+                        skipped_unknown_mapping, hoster_new_created, probe_results, multihost, sampling_info)
@@ -0,0 +1,185 @@
+"""
+Mastodon infrastructure analysis tool. See README for usage.
+Copyright 2020 Dominik Pataky <dev@bitkeks.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests of the HTTP probing against a local stand-in server. Run with "python3 -m unittest test_probe".
+"""
+
+import asyncio
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import probe
+
+INSTANCE_BODY = json.dumps({"uri": "stand-in.local", "version": "3.1.3"}).encode("utf-8")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers like the instance API of a Mastodon server, the behaviour is chosen by the request path
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def version_string(self):
+        return "nginx"
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address[1], self.path))
+
+        if self.path == "/api/v1/instance":
+            self.send_response(200)
+            self.send_header("CF-RAY", "5a1b2c3d4e5f-FRA")
+            self.send_header("Content-Length", str(len(INSTANCE_BODY)))
+            self.end_headers()
+            self.wfile.write(INSTANCE_BODY)
+        elif self.path.split("?")[0] == "/chunked/api/v1/instance":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for offset in range(0, len(INSTANCE_BODY), 10):
+                chunk = INSTANCE_BODY[offset:offset + 10]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/redirect/api/v1/instance":
+            self.send_response(302)
+            self.send_header("Location", "../../../chunked/api/v1/instance?from=redirect")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/slow/api/v1/instance":
+            time.sleep(1)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.requests = []  # (client port, path) of each request
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_stand_in(server: ThreadingHTTPServer):
+    server.shutdown()
+    server.server_close()
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_stand_in()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        stop_stand_in(self.server)
+
+    def probe(self, path: str = probe.PROBE_PATH, count: int = 1, timeout: float = probe.PROBE_TIMEOUT) -> list:
+        """
+        Probe the stand-in server count times in a row over the same connection pool
+        """
+        async def run():
+            pool = probe.ConnectionPool(timeout=timeout)
+            try:
+                return [await probe.probe_host(pool, "127.0.0.1", scheme="http", port=self.port)
+                        for _ in range(count)]
+            finally:
+                pool.close()
+
+        with mock.patch.object(probe, "PROBE_PATH", path):
+            return asyncio.run(run())
+
+    def test_cdn_header(self):
+        result, = self.probe()
+        self.assertIsNone(result.error)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(result.server, "nginx")
+        self.assertEqual(result.cdn, "cloudflare")
+        self.assertEqual(result.version, "3.1.3")
+
+    def test_chunked_body(self):
+        result, = self.probe("/chunked/api/v1/instance")
+        self.assertIsNone(result.error)
+        self.assertIsNone(result.cdn)
+        self.assertEqual(result.version, "3.1.3")
+
+    def test_relative_redirect(self):
+        result, = self.probe("/redirect/api/v1/instance")
+        self.assertIsNone(result.error)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(result.version, "3.1.3")
+        self.assertEqual([path for _, path in self.server.requests],
+                         ["/redirect/api/v1/instance", "/chunked/api/v1/instance?from=redirect"])
+
+    def test_timeout(self):
+        result, = self.probe("/slow/api/v1/instance", timeout=0.2)
+        self.assertIsNone(result.status)
+        self.assertEqual(result.error, "TimeoutError")
+
+    def test_connection_reuse(self):
+        results = self.probe(count=3)
+        self.assertTrue(all(result.status == 200 for result in results))
+        self.assertEqual(len(self.server.requests), 3)
+        # All requests were sent over the same pooled connection
+        self.assertEqual(len(set(port for port, _ in self.server.requests)), 1)
+
+    def test_idle_connections_bounded(self):
+        # Each stand-in server listens on its own port, which the pool treats as a different host
+        servers = [start_stand_in() for _ in range(8)]
+        writers = []
+        open_connection = asyncio.open_connection
+
+        async def recording_open_connection(*args, **kwargs):
+            reader, writer = await open_connection(*args, **kwargs)
+            writers.append(writer)
+            return reader, writer
+
+        async def run():
+            pool = probe.ConnectionPool()
+            try:
+                results = []
+                for server in servers:
+                    results.append(await probe.probe_host(pool, "127.0.0.1", scheme="http",
+                                                          port=server.server_address[1]))
+                    self.assertLessEqual(sum(not writer.is_closing() for writer in writers), 3)
+                return results
+            finally:
+                pool.close()
+
+        try:
+            with mock.patch.object(probe, "MAX_IDLE_CONNECTIONS", 3), \
+                    mock.patch.object(asyncio, "open_connection", recording_open_connection):
+                results = asyncio.run(run())
+        finally:
+            for server in servers:
+                stop_stand_in(server)
+
+        self.assertTrue(all(result.status == 200 for result in results))
+        self.assertEqual(len(writers), 8)
+        self.assertTrue(all(writer.is_closing() for writer in writers))
+
+
+if __name__ == "__main__":
+    unittest.main()